@@ -0,0 +1,369 @@
+"""
+Throughput, memory and accuracy benchmarks on synthetic datasets.
+
+Every benchmark runs in a fresh process so that its peak RSS is its own.
+At the smallest scale, methods are checked against a reference fit of the
+same model (see REFERENCES), and the binned kde_deviance metrics against
+those with statsmodels KDEs.
+"""
+import os
+import time
+import resource
+import warnings
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from os.path import join as pjoin
+
+import click
+import numpy
+import pandas
+
+from .synthetic import generate
+
+
+COMPARE_COLS = ["const_coef", "zipf_coef", "phi_coef", "const_err", "zipf_err", "aic"]
+DEFAULT_RTOL = 1e-6
+DEFAULT_ATOL = 1e-6
+# The reference of each family of methods by prefix: statsmodels for the
+# batched GLMs, the mleOi* fit under the same normal(0, PRIOR_SCALE) prior
+# for torchOi* and statsmodels' OrderedModel for cumulative*
+REFERENCES = {
+    "batchedGlm": "statsmodelsGlm",
+    "torchOi": "priorMleOi",
+    "cumulative": "orderedModel",
+}
+# Looser tolerances for references found by a different optimiser
+REFERENCE_TOLS = {
+    "priorMleOi": (1e-4, 1e-4),
+    "orderedModel": (1e-5, 1e-5),
+}
+# The binned KDEs are only close to statsmodels' to within a grid step
+KDE_DEVIANCE_RTOL = 1e-2
+KDE_DEVIANCE_ATOL = 1e-4
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def reference_method(method):
+    for prefix, ref in REFERENCES.items():
+        if method.startswith(prefix):
+            return ref + method[len(prefix):]
+    return None
+
+
+def reference_tols(ref, rtol, atol):
+    for prefix, (ref_rtol, ref_atol) in REFERENCE_TOLS.items():
+        if ref.startswith(prefix):
+            return max(rtol, ref_rtol), max(atol, ref_atol)
+    return rtol, atol
+
+
+def run_reference(dfin, ref):
+    for prefix, run in [("priorMleOi", run_prior_mle_oi), ("orderedModel", run_ordered_model)]:
+        if ref.startswith(prefix):
+            return run(dfin, ref[len(prefix):].lower())
+    return run_method(dfin, ref)
+
+
+def run_method(dfin, method):
+    from ..parametric.regress import FIT_COLUMNS, METHODS, BatchedMethod, fit_respondents
+
+    fit = METHODS[method]
+    columns = FIT_COLUMNS
+    if isinstance(fit, BatchedMethod) and fit.score:
+        columns = FIT_COLUMNS + ["score"]
+    df = pandas.read_parquet(dfin, columns=["respondent"] + columns)
+    start = time.perf_counter()
+    if isinstance(fit, BatchedMethod) and fit.prepare is not None:
+        # Estimated from the whole dataset as in regress.fit_dataset(...)
+        fit = fit.bind(**fit.prepare(dfin))
+    cols = fit_respondents(fit, df)
+    return time.perf_counter() - start, pandas.DataFrame(cols)
+
+
+def run_prior_mle_oi(dfin, link):
+    from ..parametric.inflated import fit_batched_inflated
+    from ..parametric.pytorch_oneinf import PRIOR_SCALE
+
+    df = pandas.read_parquet(dfin, columns=["respondent", "zipf", "known"])
+    start = time.perf_counter()
+    cols = fit_batched_inflated(df, link, one_inflated=True, prior_scale=PRIOR_SCALE)
+    return time.perf_counter() - start, pandas.DataFrame(cols)
+
+
+def run_ordered_model(dfin, link):
+    """
+    statsmodels OrderedModel fits of each respondent to the levels they
+    used, in the columns of the cumulative* methods. Respondents with a
+    single level are NaN.
+    """
+    from scipy import stats
+    from statsmodels.miscmodels.ordinal_model import OrderedModel
+    from statsmodels.tools.sm_exceptions import ConvergenceWarning
+
+    # OrderedModel has P(score above level j) = 1 - G(threshold_j - slope *
+    # zipf), which is F(slope * zipf - threshold_j) for the inverse link F
+    # when G(t) = 1 - F(-t): the same logistic or normal distribution for
+    # logit and probit, and the Gumbel (maximum) distribution for cloglog
+    distr = {"logit": "logit", "probit": "probit", "cloglog": stats.gumbel_r}[link]
+    df = pandas.read_parquet(dfin, columns=["respondent", "zipf", "score"])
+    levels = numpy.unique(df["score"])
+    start = time.perf_counter()
+    rows = []
+    for resp_idx, df_resp in df.groupby("respondent", sort=True):
+        row = {"respondent": resp_idx}
+        used = numpy.unique(df_resp["score"])
+        if len(used) >= 2:
+            model = OrderedModel(
+                df_resp["score"].to_numpy(), df_resp[["zipf"]].to_numpy(), distr=distr
+            )
+            with warnings.catch_warnings():
+                # BFGS reports precision loss once the gradient is within
+                # rounding of gtol
+                warnings.simplefilter("ignore", ConvergenceWarning)
+                res = model.fit(method="bfgs", maxiter=1000, gtol=1e-8, disp=False)
+            thresholds = model.transform_threshold_params(res.params)[1:-1]
+            # Number of used levels below each level but the lowest
+            below = numpy.searchsorted(used, levels[1:])
+            const_coefs = numpy.where(
+                below == 0,
+                numpy.inf,
+                numpy.where(
+                    below == len(used),
+                    -numpy.inf,
+                    -thresholds[numpy.clip(below - 1, 0, len(thresholds) - 1)]
+                )
+            )
+            row["const_coef"] = const_coefs[0]
+            row["zipf_coef"] = res.params[0]
+            for level, coef in zip(levels[1:], const_coefs):
+                row[f"const_coef_{level}"] = coef
+            row["aic"] = res.aic
+        rows.append(row)
+    return time.perf_counter() - start, pandas.DataFrame(rows)
+
+
+def run_nonparametric(dfin, backend):
+    from ..nonparametric.nonparametric import (
+        BinnedNonParametricEstimator,
+        NonParametricEstimator,
+    )
+    from ..nonparametric.transfer import ZIPF_X
+
+    df = pandas.read_parquet(dfin)
+    start = time.perf_counter()
+    if backend == "binned":
+        BinnedNonParametricEstimator.from_df(df, "zipf", "known").evaluate(ZIPF_X)
+    else:
+        for _, df_resp in df.groupby("respondent"):
+            NonParametricEstimator.from_df(
+                df_resp, "zipf", "known", backend=backend
+            ).evaluate(ZIPF_X)
+    return time.perf_counter() - start, None
+
+
+def run_kde_deviance(dfin, fitin, method, backend="binned", bw_kwargs=None):
+    from ..nonparametric.kde_deviance import shard_deviance
+    from ..nonparametric.regression import method_regression_config
+
+    fit_df = pandas.read_parquet(fitin)
+    start = time.perf_counter()
+    df_dev = shard_deviance(
+        dfin, fit_df, method_regression_config(method), bw_kwargs=bw_kwargs, backend=backend
+    )
+    return time.perf_counter() - start, df_dev
+
+
+def run_overlay(dfin):
+    from ..nonparametric.overlay_transfer import (
+        NUM_SAMPLE_POINTS,
+        resample_nonparameteric,
+    )
+
+    df = pandas.read_parquet(dfin)
+    zipf_x = numpy.linspace(0, 7, NUM_SAMPLE_POINTS)
+    std_x = numpy.linspace(0, 1, NUM_SAMPLE_POINTS)
+    start = time.perf_counter()
+    resample_nonparameteric([df], zipf_x, std_x)
+    return time.perf_counter() - start, None
+
+
+def measure(func, *args):
+    """
+    Run func(*args) in a fresh process returning (seconds, result, peak RSS
+    in MB, error).
+    """
+    with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as executor:
+        future = executor.submit(_measure_child, func, *args)
+        return future.result()
+
+
+def _measure_child(func, *args):
+    try:
+        seconds, result = func(*args)
+        return seconds, result, peak_rss_mb(), None
+    except Exception as exc:
+        return numpy.nan, None, peak_rss_mb(), f"{type(exc).__name__}: {exc}"
+
+
+def check_accuracy(df_fit, df_ref, rtol, atol, cols=COMPARE_COLS):
+    merged = df_fit.merge(df_ref, on="respondent", suffixes=("", "_ref"))
+    failures = {}
+    for col in cols:
+        if col not in df_fit or col not in df_ref:
+            continue
+        fit_vals = merged[col].to_numpy()
+        ref_vals = merged[col + "_ref"].to_numpy()
+        ok = numpy.isclose(fit_vals, ref_vals, rtol=rtol, atol=atol, equal_nan=True)
+        if not ok.all():
+            failures[col] = int((~ok).sum())
+    return failures
+
+
+def bench_scale(workdir, respondents, items, link, inflation, levels, methods, rtol, atol, check):
+    dfin = pjoin(workdir, f"synthetic_{respondents}.parquet")
+    df, truth = generate(
+        respondents=respondents, items=items, link=link, inflation=inflation,
+        levels=levels
+    )
+    df.to_parquet(dfin)
+    del df
+    rows = []
+
+    def record(benchmark, seconds, rss, error, **extra):
+        row = {
+            "benchmark": benchmark,
+            "respondents": respondents,
+            "items": items,
+            "seconds": seconds,
+            "respondents_per_sec": respondents / seconds,
+            "peak_rss_mb": rss,
+            "error": error,
+        }
+        row.update(extra)
+        print(row)
+        rows.append(row)
+
+    fits = {}
+    for method in methods:
+        seconds, df_fit, rss, error = measure(run_method, dfin, method)
+        extra = {}
+        if df_fit is not None:
+            fits[method] = df_fit
+            merged = df_fit.merge(truth, on="respondent", suffixes=("", "_true"))
+            extra["zipf_coef_mae"] = float(
+                (merged["zipf_coef"] - merged["zipf_coef_true"]).abs().mean()
+            )
+        record(f"regress:{method}", seconds, rss, error, **extra)
+
+    if check:
+        ref_errors = {}
+        for method, df_fit in list(fits.items()):
+            ref = reference_method(method)
+            if ref is None:
+                continue
+            if ref not in fits:
+                _, fits[ref], _, ref_errors[ref] = measure(run_reference, dfin, ref)
+            if fits[ref] is None:
+                failures = {"reference": ref_errors[ref]}
+            else:
+                cols = COMPARE_COLS + [col for col in df_fit if col.startswith("const_coef_")]
+                failures = check_accuracy(
+                    df_fit, fits[ref], *reference_tols(ref, rtol, atol), cols
+                )
+            status = "ok" if not failures else f"MISMATCH {failures}"
+            print(f"Accuracy {method} vs {ref}: {status}")
+            rows.append({
+                "benchmark": f"accuracy:{method}",
+                "respondents": respondents,
+                "items": items,
+                "error": None if not failures else str(failures),
+            })
+
+    for backend in ["statsmodels", "binned"]:
+        seconds, _, rss, error = measure(run_nonparametric, dfin, backend)
+        record(f"nonparametric:{backend}", seconds, rss, error)
+
+    fit_method = next((m for m in methods if m in fits), None)
+    if fit_method is not None:
+        fitin = pjoin(workdir, f"fit_{respondents}.parquet")
+        fits[fit_method].to_parquet(fitin)
+        seconds, _, rss, error = measure(run_kde_deviance, dfin, fitin, fit_method)
+        record("kde_deviance", seconds, rss, error)
+        if check:
+            from ..nonparametric.kde_deviance import METRICS
+
+            # LSCV picks the narrowest bandwidths, leaving the most of each
+            # respondent's zipf range unsupported
+            devs = {
+                backend: measure(
+                    run_kde_deviance, dfin, fitin, fit_method, backend, {"bw": "lscv"}
+                )[1]
+                for backend in ["binned", "statsmodels"]
+            }
+            if any(dev is None for dev in devs.values()):
+                failures = {"error": "kde_deviance failed"}
+            else:
+                failures = check_accuracy(
+                    devs["binned"], devs["statsmodels"], KDE_DEVIANCE_RTOL,
+                    KDE_DEVIANCE_ATOL, METRICS
+                )
+                nans = int(devs["binned"][METRICS].isna().to_numpy().sum())
+                if nans:
+                    failures["nan"] = nans
+            status = "ok" if not failures else f"MISMATCH {failures}"
+            print(f"Accuracy kde_deviance binned vs statsmodels: {status}")
+            rows.append({
+                "benchmark": "accuracy:kde_deviance",
+                "respondents": respondents,
+                "items": items,
+                "error": None if not failures else str(failures),
+            })
+
+    seconds, _, rss, error = measure(run_overlay, dfin)
+    record("get_overlay", seconds, rss, error)
+    return rows
+
+
+@click.command()
+@click.option("--scales", default="100,1000", help="Comma separated respondent counts")
+@click.option("--items", type=int, default=200)
+@click.option("--link", default="logit")
+@click.option("--inflation", type=click.Choice(["none", "oi", "zi"]), default="none")
+@click.option("--levels", type=click.IntRange(min=2), default=2, help="Number of score levels")
+@click.option("--method", "methods", multiple=True, help="regress.py methods (default: all)")
+@click.option("--rtol", type=float, default=DEFAULT_RTOL)
+@click.option("--atol", type=float, default=DEFAULT_ATOL)
+@click.option("--out", type=click.Path(), help="Write the results table to this parquet file")
+def main(scales, items, link, inflation, levels, methods, rtol, atol, out):
+    from ..parametric.regress import METHODS
+
+    scales = sorted(int(scale) for scale in scales.split(","))
+    if not methods:
+        methods = list(METHODS)
+    rows = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for scale_idx, respondents in enumerate(scales):
+            rows.extend(bench_scale(
+                workdir, respondents, items, link, inflation, levels, methods,
+                rtol, atol, check=scale_idx == 0
+            ))
+    df_out = pandas.DataFrame(rows)
+    with pandas.option_context("display.max_rows", None, "display.width", 200):
+        print(df_out.drop(columns=["error"]))
+    errors = df_out[df_out["error"].notna()]
+    if len(errors):
+        print("Errors:")
+        for _, row in errors.iterrows():
+            print(f"  {row['benchmark']} @ {row['respondents']}: {row['error']}")
+    if out is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+        df_out.to_parquet(out)
+
+
+if __name__ == "__main__":
+    main()
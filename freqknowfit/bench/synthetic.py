@@ -0,0 +1,95 @@
+"""
+Synthetic *.enriched.parquet files with known per-respondent parameters.
+"""
+import click
+import numpy
+import pandas
+
+from ..parametric.links import LINKS
+
+
+def generate(
+    respondents=1000,
+    items=200,
+    link="logit",
+    inflation="none",
+    levels=2,
+    shared_items=False,
+    seed=0,
+    const_mean=-5.0,
+    const_sd=1.0,
+    zipf_mean=1.5,
+    zipf_sd=0.3,
+    phi_mean=-2.0,
+    phi_sd=0.5,
+):
+    """
+    Returns (df, truth) where df has the respondent, zipf, known and score
+    columns of an enriched dataset and truth has the const_coef, zipf_coef
+    and (if inflated) phi_coef used to generate each respondent.
+    """
+    if levels < 2:
+        raise ValueError(f"Need at least 2 score levels, not {levels}")
+    rng = numpy.random.default_rng(seed)
+    link_funcs = LINKS[link]
+    truth = pandas.DataFrame({
+        "respondent": numpy.arange(respondents),
+        "const_coef": rng.normal(const_mean, const_sd, respondents),
+        "zipf_coef": rng.normal(zipf_mean, zipf_sd, respondents),
+    })
+    if inflation != "none":
+        truth["phi_coef"] = rng.normal(phi_mean, phi_sd, respondents)
+    codes = numpy.repeat(numpy.arange(respondents), items)
+    if shared_items:
+        zipf = numpy.tile(rng.uniform(0, 7, items), respondents)
+    else:
+        zipf = rng.uniform(0, 7, respondents * items)
+    eta = truth["const_coef"].to_numpy()[codes] + truth["zipf_coef"].to_numpy()[codes] * zipf
+    prob = link_funcs.inverse(eta)
+    if inflation != "none":
+        inflate_prob = 1 / (1 + numpy.exp(-truth["phi_coef"].to_numpy()[codes]))
+        if inflation == "oi":
+            prob = inflate_prob + (1 - inflate_prob) * prob
+        elif inflation == "zi":
+            prob = (1 - inflate_prob) * prob
+        else:
+            raise ValueError(f"Unknown inflation: {inflation}")
+    known = rng.random(len(prob)) < prob
+    # Known items get higher scores the more frequent they are
+    score = known * (1 + rng.binomial(levels - 2, link_funcs.inverse(eta)))
+    df = pandas.DataFrame({
+        "respondent": codes,
+        "zipf": zipf,
+        "known": known,
+        "score": score.astype(numpy.int8),
+    })
+    return df, truth
+
+
+@click.command()
+@click.argument("dfout", type=click.Path())
+@click.option("--truth", "truth_out", type=click.Path(), help="Where to write the true parameters")
+@click.option("--respondents", type=int, default=1000)
+@click.option("--items", type=int, default=200)
+@click.option("--link", type=click.Choice(list(LINKS)), default="logit")
+@click.option("--inflation", type=click.Choice(["none", "oi", "zi"]), default="none")
+@click.option("--levels", type=click.IntRange(min=2), default=2, help="Number of score levels")
+@click.option("--shared-items/--random-items", default=False)
+@click.option("--seed", type=int, default=0)
+def main(dfout, truth_out, respondents, items, link, inflation, levels, shared_items, seed):
+    df, truth = generate(
+        respondents=respondents,
+        items=items,
+        link=link,
+        inflation=inflation,
+        levels=levels,
+        shared_items=shared_items,
+        seed=seed,
+    )
+    df.to_parquet(dfout)
+    if truth_out is not None:
+        truth.to_parquet(truth_out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,355 @@
+"""
+Compact, respondent sorted caches of *.enriched.parquet files.
+
+A cache is a directory of .npy arrays which are memory mapped on opening:
+
+ * offsets.npy: int64 row offsets so that respondent code i has rows
+   offsets[i]:offsets[i + 1]
+ * zipf.npy: float32
+ * known.npy: known bit packed with numpy.packbits(...)
+ * score.npy: the smallest integer type which holds the scores (float32
+   if they are not integers), if present
+
+along with respondents.parquet, the dictionary from respondent codes to
+the original respondent IDs, and META_NAME. Slices of zipf and score for a
+respondent are views of the mapped files.
+
+When every respondent answers the same items, a cache can instead have the
+dense layout of freqknowfit.dense: items.npy holds the float64 zipfs of
+the items once, known.npy holds each respondent's row of the known matrix
+bit packed separately and score.npy is a (respondent x item) matrix.
+
+The functions in dataset accept a cache wherever they accept a parquet
+file, giving DataFrames with zipf widened back to float64. Note that zipf
+is rounded to float32 though.
+"""
+import json
+import os
+from os.path import exists, join as pjoin
+
+import click
+import numpy
+import pandas
+
+from .dense import DenseResponses
+
+
+META_NAME = "meta.json"
+VERSION = 1
+SCORE_DTYPES = [numpy.int8, numpy.int16, numpy.int32]
+
+
+def is_compact(path):
+    return os.path.isdir(path) and exists(pjoin(path, META_NAME))
+
+
+def score_dtype(column_type, lo, hi):
+    if not column_type.endswith("INT") and column_type not in ("BOOLEAN",):
+        return numpy.float32
+    for dtype in SCORE_DTYPES:
+        info = numpy.iinfo(dtype)
+        if info.min <= lo and hi <= info.max:
+            return dtype
+    return numpy.int64
+
+
+class CompactDataset:
+    def __init__(self, path):
+        with open(pjoin(path, META_NAME)) as inf:
+            self.meta = json.load(inf)
+        if self.meta["version"] != VERSION:
+            raise ValueError(f"Unsupported compact dataset version in {path}")
+        self.dense = self.meta.get("layout", "long") == "dense"
+        self.respondents = pandas.Index(
+            pandas.read_parquet(pjoin(path, "respondents.parquet"))["respondent"]
+        )
+        self.offsets = numpy.load(pjoin(path, "offsets.npy"), mmap_mode="r")
+        if self.dense:
+            self.items = numpy.load(pjoin(path, "items.npy"))
+        else:
+            self.zipf = numpy.load(pjoin(path, "zipf.npy"), mmap_mode="r")
+        self.known_bits = numpy.load(pjoin(path, "known.npy"), mmap_mode="r")
+        self.score = None
+        if self.meta["has_score"]:
+            self.score = numpy.load(pjoin(path, "score.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.respondents)
+
+    def sizes(self):
+        return pandas.Series(
+            numpy.diff(self.offsets),
+            index=self.respondents.rename("respondent"),
+            name="size"
+        )
+
+    def codes(self, respondents=None):
+        """
+        Sorted codes of respondents, ignoring those not in the cache.
+        """
+        if respondents is None:
+            return numpy.arange(len(self))
+        codes = self.respondents.get_indexer(list(respondents))
+        return numpy.unique(codes[codes >= 0])
+
+    def known(self, lo, hi):
+        first_byte = lo // 8
+        bits = numpy.unpackbits(
+            self.known_bits[first_byte:(hi + 7) // 8]
+        )
+        start = lo - first_byte * 8
+        return bits[start:start + hi - lo].astype(bool)
+
+    def known_rows(self, rows):
+        return numpy.unpackbits(
+            self.known_bits[rows], axis=-1, count=len(self.items)
+        ).astype(bool)
+
+    def respondent(self, code):
+        """
+        zipf, known and score (or None) for a single respondent code. zipf
+        and score are views of the memory mapped files.
+        """
+        if self.dense:
+            return (
+                self.items,
+                self.known_rows(code),
+                None if self.score is None else self.score[code],
+            )
+        lo, hi = self.offsets[code], self.offsets[code + 1]
+        return (
+            self.zipf[lo:hi],
+            self.known(lo, hi),
+            None if self.score is None else self.score[lo:hi],
+        )
+
+    def frame(self, codes, columns=None):
+        """
+        A DataFrame of the rows of the given sorted respondent codes with
+        columns like the enriched parquet file.
+        """
+        if self.dense:
+            return self.matrix(codes).to_frame(columns)
+        if columns is None:
+            columns = ["zipf", "known"] + (["score"] if self.score is not None else [])
+        offsets = numpy.asarray(self.offsets)
+        los = offsets[codes]
+        his = offsets[numpy.asarray(codes) + 1]
+        contiguous = len(codes) and numpy.array_equal(los[1:], his[:-1])
+        if contiguous:
+            rows = slice(los[0], his[-1])
+        else:
+            rows = numpy.concatenate(
+                [numpy.arange(lo, hi) for lo, hi in zip(los, his)]
+                or [numpy.zeros(0, dtype=numpy.int64)]
+            )
+        data = {
+            "respondent": self.respondents[
+                numpy.repeat(numpy.asarray(codes, dtype=numpy.int64), his - los)
+            ]
+        }
+        for col in columns:
+            if col == "respondent":
+                continue
+            elif col == "zipf":
+                # Widened so that fits see the same dtype as with parquet
+                data["zipf"] = self.zipf[rows].astype(numpy.float64)
+            elif col == "known":
+                if contiguous:
+                    data["known"] = self.known(los[0], his[-1])
+                else:
+                    data["known"] = numpy.concatenate(
+                        [self.known(lo, hi) for lo, hi in zip(los, his)]
+                        or [numpy.zeros(0, dtype=bool)]
+                    )
+            elif col == "score" and self.score is not None:
+                data["score"] = self.score[rows]
+            else:
+                raise KeyError(f"Column {col} is not in the compact dataset")
+        return pandas.DataFrame(data)
+
+    def matrix(self, codes):
+        """
+        DenseResponses of the given sorted respondent codes of a dense cache.
+        """
+        codes = numpy.asarray(codes, dtype=numpy.int64)
+        rows = codes
+        if len(codes) and codes[-1] - codes[0] + 1 == len(codes):
+            rows = slice(codes[0], codes[-1] + 1)
+        return DenseResponses(
+            self.respondents[codes],
+            self.items,
+            self.known_rows(rows),
+            None if self.score is None else self.score[rows]
+        )
+
+    def iter_codes(self, respondents=None, chunk_rows=None):
+        codes = self.codes(respondents)
+        if chunk_rows is None:
+            yield codes
+            return
+        sizes = numpy.diff(numpy.asarray(self.offsets))[codes]
+        chunk_of_code = (numpy.cumsum(sizes) - sizes) // chunk_rows
+        bounds = numpy.flatnonzero(numpy.diff(chunk_of_code)) + 1
+        for chunk_codes in numpy.split(codes, bounds):
+            if len(chunk_codes):
+                yield chunk_codes
+
+    def iter_frames(self, columns=None, respondents=None, chunk_rows=None):
+        """
+        Yield DataFrames of whole respondents of roughly chunk_rows rows.
+        """
+        for codes in self.iter_codes(respondents, chunk_rows):
+            yield self.frame(codes, columns)
+
+    def iter_matrices(self, respondents=None, chunk_rows=None):
+        """
+        Yield DenseResponses of roughly chunk_rows responses each from a
+        dense cache.
+        """
+        for codes in self.iter_codes(respondents, chunk_rows):
+            yield self.matrix(codes)
+
+
+def write_long(dfin, out_dir, num_rows, read_columns, new_score):
+    from numpy.lib.format import open_memmap
+    from .dataset import iter_chunks
+
+    score = new_score((num_rows,))
+    zipf = open_memmap(pjoin(out_dir, "zipf.npy"), mode="w+", dtype=numpy.float32, shape=(num_rows,))
+    known = open_memmap(pjoin(out_dir, "known.npy"), mode="w+", dtype=numpy.uint8, shape=((num_rows + 7) // 8,))
+    pos = 0
+    # Bits which didn't fill a byte at the end of the previous chunk
+    carry = numpy.zeros(0, dtype=bool)
+    for chunk in iter_chunks(dfin, read_columns, sort=True):
+        end = pos + len(chunk)
+        zipf[pos:end] = chunk["zipf"].to_numpy(dtype=numpy.float32)
+        if score is not None:
+            score[pos:end] = chunk["score"].to_numpy()
+        bits = numpy.concatenate([carry, chunk["known"].to_numpy(dtype=bool)])
+        full = len(bits) // 8 * 8
+        byte_pos = (pos - len(carry)) // 8
+        known[byte_pos:byte_pos + full // 8] = numpy.packbits(bits[:full])
+        carry = bits[full:]
+        pos = end
+    if len(carry):
+        known[pos // 8] = numpy.packbits(carry)[0]
+    return [zipf, known, score]
+
+
+def write_dense(dfin, out_dir, sizes, read_columns, new_score):
+    from numpy.lib.format import open_memmap
+    from .dataset import iter_chunks
+
+    if sizes.nunique() > 1:
+        raise ValueError(
+            f"{dfin} can't have a dense layout: respondents answer different numbers of items"
+        )
+    num_resps = len(sizes)
+    num_items = int(sizes.iloc[0]) if num_resps else 0
+    score = new_score((num_resps, num_items))
+    known = open_memmap(
+        pjoin(out_dir, "known.npy"),
+        mode="w+",
+        dtype=numpy.uint8,
+        shape=(num_resps, (num_items + 7) // 8)
+    )
+    items = None
+    pos = 0
+    for chunk in iter_chunks(dfin, read_columns, sort=True):
+        dense = DenseResponses.from_frame(chunk)
+        if dense is None or (items is not None and not numpy.array_equal(dense.zipf, items)):
+            raise ValueError(f"{dfin} can't have a dense layout: respondents answer different items")
+        items = dense.zipf
+        end = pos + len(dense)
+        known[pos:end] = numpy.packbits(dense.known, axis=1)
+        if score is not None:
+            score[pos:end] = dense.score
+        pos = end
+    numpy.save(
+        pjoin(out_dir, "items.npy"),
+        items if items is not None else numpy.zeros(0)
+    )
+    return [known, score]
+
+
+def write_compact(dfin, out_dir, dense=False):
+    """
+    Write a compact cache of the enriched parquet file dfin to out_dir,
+    with the dense layout if dense.
+    """
+    from numpy.lib.format import open_memmap
+    from .dataset import respondent_sizes
+
+    os.makedirs(out_dir, exist_ok=True)
+    meta_path = pjoin(out_dir, META_NAME)
+    # Only valid once the metadata is written
+    if exists(meta_path):
+        os.remove(meta_path)
+    for name in ["zipf.npy", "items.npy", "score.npy"]:
+        if exists(pjoin(out_dir, name)):
+            os.remove(pjoin(out_dir, name))
+    sizes = respondent_sizes(dfin)
+    num_rows = int(sizes.sum())
+    offsets = numpy.zeros(len(sizes) + 1, dtype=numpy.int64)
+    numpy.cumsum(sizes.to_numpy(), out=offsets[1:])
+    numpy.save(pjoin(out_dir, "offsets.npy"), offsets)
+    sizes.index.to_frame(index=False).to_parquet(pjoin(out_dir, "respondents.parquet"))
+
+    import duckdb
+
+    con = duckdb.connect()
+    column_types = con.execute(
+        "DESCRIBE SELECT * FROM read_parquet(?)", [dfin]
+    ).df().set_index("column_name")["column_type"]
+    has_score = "score" in column_types
+    read_columns = ["zipf", "known"]
+    dtype = None
+    if has_score:
+        read_columns.append("score")
+        score_min, score_max = con.execute(
+            "SELECT min(score), max(score) FROM read_parquet(?)", [dfin]
+        ).fetchone()
+        dtype = score_dtype(column_types["score"], score_min or 0, score_max or 0)
+
+    def new_score(shape):
+        if dtype is None:
+            return None
+        return open_memmap(pjoin(out_dir, "score.npy"), mode="w+", dtype=dtype, shape=shape)
+
+    if dense:
+        arrays = write_dense(dfin, out_dir, sizes, read_columns, new_score)
+    else:
+        arrays = write_long(dfin, out_dir, num_rows, read_columns, new_score)
+    for arr in arrays:
+        if arr is not None:
+            arr.flush()
+    with open(meta_path, "w") as outf:
+        json.dump({
+            "version": VERSION,
+            "layout": "dense" if dense else "long",
+            "source": os.path.abspath(dfin),
+            "num_rows": num_rows,
+            "num_respondents": len(sizes),
+            "has_score": has_score,
+        }, outf)
+
+
+@click.command()
+@click.argument("dfin", type=click.Path(exists=True))
+@click.argument("out_dir", type=click.Path())
+@click.option(
+    "--dense/--long",
+    default=False,
+    help="Store the items once and known as a respondent x item matrix. "
+    "Every respondent must answer the same items."
+)
+def main(dfin, out_dir, dense):
+    """
+    Write a compact cache of the enriched parquet file DFIN to OUT_DIR.
+    """
+    write_compact(dfin, out_dir, dense)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""
+Streaming access to *.enriched.parquet files.
+
+Column projection and respondent filters are pushed down into a DuckDB scan,
+which hands back rows in file order a record batch at a time. Batches are
+then cut at respondent boundaries so that callers only ever see whole
+respondents, and peak memory is bounded by twice the chunk size (or the
+largest respondent if that is bigger) rather than the whole dataset. This
+needs the file to be sorted by respondent, which is checked as it is read.
+Files which aren't can be streamed with a full sort by DuckDB (sort=True),
+as done once when writing a compact cache.
+
+Wherever a path is taken, a compact cache written by freqknowfit.compact
+can be given instead of the parquet file.
+"""
+import numpy
+import pandas
+
+from .compact import CompactDataset, is_compact
+
+
+CHUNK_ROWS = 1 << 20
+
+
+def quote_literal(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def connect(respondents=None):
+    import duckdb
+
+    con = duckdb.connect()
+    if respondents is not None:
+        import pyarrow
+
+        con.register(
+            "wanted_respondents",
+            pyarrow.table({"respondent": list(respondents)})
+        )
+    return con
+
+
+def scan_sql(path, columns=None, respondents=None):
+    if columns is None:
+        select = "*"
+    else:
+        select = ", ".join(
+            ["respondent"] + [col for col in columns if col != "respondent"]
+        )
+    sql = f"SELECT {select} FROM read_parquet({quote_literal(path)})"
+    if respondents is not None:
+        sql += " WHERE respondent IN (SELECT respondent FROM wanted_respondents)"
+    return sql
+
+
+def read_dataset(path, columns=None, respondents=None):
+    if is_compact(path):
+        return next(CompactDataset(path).iter_frames(columns, respondents))
+    con = connect(respondents)
+    sql = scan_sql(path, columns, respondents) + " ORDER BY respondent"
+    return con.execute(sql).df()
+
+
+def respondent_sizes(path, respondents=None):
+    """
+    Number of rows for each respondent as a Series sorted by respondent.
+    Only the respondent column is read.
+    """
+    if is_compact(path):
+        dataset = CompactDataset(path)
+        return dataset.sizes().iloc[dataset.codes(respondents)]
+    con = connect(respondents)
+    sql = (
+        "SELECT respondent, count(*) AS size FROM ("
+        + scan_sql(path, [], respondents)
+        + ") GROUP BY respondent ORDER BY respondent"
+    )
+    return con.execute(sql).df().set_index("respondent")["size"]
+
+
+def score_levels(path):
+    """
+    The distinct scores of a dataset in increasing order.
+    """
+    if is_compact(path):
+        dataset = CompactDataset(path)
+        if dataset.score is None:
+            raise ValueError(f"{path} has no score column")
+        return numpy.unique(dataset.score)
+    con = connect()
+    sql = f"SELECT DISTINCT score FROM read_parquet({quote_literal(path)}) ORDER BY score"
+    return con.execute(sql).df()["score"].to_numpy()
+
+
+def is_dense(path):
+    """
+    Whether path is a compact cache with the dense layout of
+    freqknowfit.dense.
+    """
+    return is_compact(path) and CompactDataset(path).dense
+
+
+def iter_chunks(path, columns=None, respondents=None, chunk_rows=CHUNK_ROWS, allow_dense=False, sort=False):
+    """
+    Yield DataFrames of roughly chunk_rows rows each holding only whole
+    respondents, in respondent order. With allow_dense, a dense cache gives
+    DenseResponses instead.
+
+    A parquet file is read in file order and must be sorted by respondent
+    (ValueError otherwise) unless sort, which sorts the whole projection
+    first.
+    """
+    if allow_dense and is_dense(path):
+        yield from CompactDataset(path).iter_matrices(respondents, chunk_rows)
+        return
+    if is_compact(path):
+        yield from CompactDataset(path).iter_frames(columns, respondents, chunk_rows)
+        return
+    con = connect(respondents)
+    sql = scan_sql(path, columns, respondents)
+    if sort:
+        sql += " ORDER BY respondent"
+    reader = con.execute(sql).fetch_record_batch(chunk_rows)
+    # Whole respondents held back so that the last respondent can be added
+    # to them rather than yielded on their own
+    pending = None
+    carry = None
+    for batch in reader:
+        df = batch.to_pandas()
+        if carry is not None:
+            df = pandas.concat([carry, df], ignore_index=True)
+        if not len(df):
+            continue
+        resps = df["respondent"].to_numpy()
+        # Each batch starts with the carried respondent so this also checks
+        # the order across batches
+        if (resps[1:] < resps[:-1]).any():
+            raise ValueError(
+                f"{path} is not sorted by respondent: sort it or write a "
+                "compact cache of it with freqknowfit.compact"
+            )
+        # The last respondent may continue into the next batch
+        split = int((resps == resps[-1]).argmax())
+        if split > 0:
+            if pending is not None:
+                yield pending
+            pending = df.iloc[:split]
+        carry = df.iloc[split:]
+    last = [df for df in [pending, carry] if df is not None]
+    if last:
+        yield pandas.concat(last, ignore_index=True)
+
+
+def iter_respondents(path, columns=None, respondents=None, chunk_rows=CHUNK_ROWS):
+    """
+    Yield (respondent, df_resp) pairs in the same order as
+    pandas.read_parquet(path).groupby("respondent") without loading the
+    whole file.
+    """
+    for chunk in iter_chunks(path, columns, respondents, chunk_rows):
+        yield from chunk.groupby("respondent", sort=False)
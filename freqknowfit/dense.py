@@ -0,0 +1,86 @@
+"""
+Dense respondent x item responses for datasets where every respondent
+answers the same items, such as svl12k.
+
+Only zipf matters to the models here, so items are identified by their
+zipf: the zipfs are stored once, sorted, and known (and score) become
+(respondent x item) matrices with columns in the same order. Items with
+equal zipfs are interchangeable. Per-respondent sums over items then become
+matrix products with the shared zipfs.
+"""
+import numpy
+import pandas
+
+
+class DenseResponses:
+    def __init__(self, respondents, zipf, known, score=None):
+        self.respondents = pandas.Index(respondents, name="respondent")
+        self.zipf = numpy.asarray(zipf, dtype=float)
+        self.known = numpy.asarray(known, dtype=bool)
+        self.score = score
+
+    def __len__(self):
+        return len(self.respondents)
+
+    @property
+    def num_items(self):
+        return len(self.zipf)
+
+    @classmethod
+    def from_frame(cls, df):
+        """
+        The dense form of a DataFrame of whole respondents, or None if they
+        didn't all answer the same items.
+        """
+        codes, respondents = pandas.factorize(df["respondent"], sort=True)
+        counts = numpy.bincount(codes, minlength=len(respondents))
+        if not len(counts) or (counts != counts[0]).any():
+            return None
+        order = numpy.lexsort((df["zipf"].to_numpy(), codes))
+        shape = (len(respondents), counts[0])
+        zipf = df["zipf"].to_numpy(dtype=float)[order].reshape(shape)
+        if (zipf != zipf[:1]).any():
+            return None
+        score = None
+        if "score" in df:
+            score = df["score"].to_numpy()[order].reshape(shape)
+        return cls(
+            respondents,
+            zipf[0],
+            df["known"].to_numpy(dtype=bool)[order].reshape(shape),
+            score
+        )
+
+    def take(self, rows):
+        """
+        The respondents at the positions (or slice) rows.
+        """
+        return DenseResponses(
+            self.respondents[rows],
+            self.zipf,
+            self.known[rows],
+            None if self.score is None else self.score[rows]
+        )
+
+    def drop_respondents(self, respondents):
+        return self.take(~self.respondents.isin(list(respondents)))
+
+    def to_frame(self, columns=None):
+        """
+        The long form, with one row per respondent and item.
+        """
+        if columns is None:
+            columns = ["zipf", "known"] + (["score"] if self.score is not None else [])
+        data = {"respondent": self.respondents.repeat(self.num_items)}
+        for col in columns:
+            if col == "respondent":
+                continue
+            elif col == "zipf":
+                data["zipf"] = numpy.tile(self.zipf, len(self))
+            elif col == "known":
+                data["known"] = self.known.ravel()
+            elif col == "score" and self.score is not None:
+                data["score"] = numpy.asarray(self.score).ravel()
+            else:
+                raise KeyError(f"Column {col} is not in the dense responses")
+        return pandas.DataFrame(data)
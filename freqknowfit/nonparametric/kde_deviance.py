@@ -3,36 +3,135 @@ import pandas
 import numpy
 from scipy.integrate import trapezoid
 
-from .nonparametric import NonParametricEstimator
-from .utils import IterFittedResps
+from .nonparametric import (
+    NonParametricEstimator,
+    NonParametricResult,
+    bandwidth_kwargs,
+    chunk_estimator,
+)
+from .regression import method_regression_config, reg_curves
+from ..dataset import iter_chunks, respondent_sizes
+from ..dense import DenseResponses
+from ..parametric.regress import split_respondents
+from ..parametric.results import read_fit_method
 
 
 SAMPLES = numpy.linspace(0, 7, 1000)
+DATA_COLUMNS = ["zipf", "known"]
+METRICS = ["mae", "mse", "weighted_mae", "weighted_mse"]
+BACKENDS = ["binned", "statsmodels"]
 
 
-def logistic(m, c):
-    return 1 / (1 + numpy.exp(-(c + m * SAMPLES)))
+def align_fits(fit_df, respondents):
+    # R writes respondents as strings so match on those
+    by_resp = fit_df.set_index(fit_df["respondent"].astype(str))
+    missing = ~pandas.Index(respondents.astype(str)).isin(by_resp.index)
+    if missing.any():
+        raise ValueError(
+            f"Couldn't get fitted model for {respondents[missing][0]}"
+        )
+    return by_resp.loc[respondents.astype(str)]
+
+
+def evaluate_chunk(chunk, bw_kwargs=None, backend="binned"):
+    """
+    The respondents of chunk and a NonParametricResult of (respondent x
+    SAMPLES) arrays, from the batched estimator or one statsmodels KDE pair
+    per respondent.
+    """
+    bw_kwargs = bw_kwargs or {}
+    if backend == "binned":
+        est = chunk_estimator(chunk, **bw_kwargs)
+        return est.groups, est.evaluate(SAMPLES)
+    elif backend != "statsmodels":
+        raise ValueError(f"Unknown backend: {backend}")
+    if isinstance(chunk, DenseResponses):
+        chunk = chunk.to_frame()
+    groups = []
+    results = []
+    for resp_idx, df_resp in chunk.groupby("respondent", sort=True):
+        groups.append(resp_idx)
+        results.append(
+            NonParametricEstimator.from_df(df_resp, "zipf", "known", **bw_kwargs).evaluate(SAMPLES)
+        )
+    return pandas.Index(groups), NonParametricResult(
+        numpy.array([result.known_y for result in results]),
+        numpy.array([result.unknown_y for result in results]),
+    )
+
+
+def chunk_deviance(df, fit_df, fit_conf, bw_kwargs=None, backend="binned"):
+    groups, nonparametric_eval = evaluate_chunk(df, bw_kwargs, backend)
+    fit_rows = align_fits(fit_df, groups)
+    trans = nonparametric_eval.transfer()
+    supp = nonparametric_eval.support()
+    predictions = reg_curves(
+        fit_conf,
+        fit_rows["const_coef"].to_numpy()[:, None],
+        fit_rows["zipf_coef"].to_numpy()[:, None],
+        fit_rows["phi_coef"].to_numpy()[:, None] if "phi_coef" in fit_rows else None,
+        SAMPLES[None, :]
+    )
+    # Only integrated where the respondent has support, since the transfer
+    # is NaN elsewhere
+    err = numpy.where(numpy.isfinite(trans), trans - predictions, 0)
+    abs_err = numpy.abs(err)
+    sq_err = err ** 2
+    return pandas.DataFrame({
+        "respondent": groups.to_numpy(),
+        "mae": trapezoid(abs_err, SAMPLES, axis=1),
+        "mse": trapezoid(sq_err, SAMPLES, axis=1),
+        "weighted_mae": trapezoid(supp * abs_err, SAMPLES, axis=1),
+        "weighted_mse": trapezoid(supp * sq_err, SAMPLES, axis=1),
+    })
+
+
+def shard_deviance(dfin, fit_df, fit_conf, respondents=None, bw_kwargs=None, backend="binned"):
+    return pandas.concat(
+        [
+            chunk_deviance(chunk, fit_df, fit_conf, bw_kwargs, backend)
+            for chunk in iter_chunks(dfin, DATA_COLUMNS, respondents, allow_dense=True)
+        ],
+        ignore_index=True
+    )
 
 
 @click.command()
 @click.argument("dfin", type=click.Path(exists=True))
 @click.argument("fitin", type=click.Path(exists=True))
-def main(dfin, fitin):
-    cols = {"respondent": [], "mae": [], "mse": [], "weighted_mae": [], "weighted_mse": []}
-    for resp_idx, df_resp, fit_row in IterFittedResps(dfin, fitin):
-        predictions = logistic(fit_row["zipf_coef"].to_numpy(), fit_row["const_coef"].to_numpy())
-        nonparametric_est = NonParametricEstimator.from_df(df_resp, "zipf", "known")
-        nonparametric_eval = nonparametric_est.evaluate(SAMPLES)
-        trans = nonparametric_eval.transfer()
-        supp = nonparametric_eval.support()
-        cols["respondent"].append(resp_idx)
-        cols["mae"].append(trapezoid(numpy.abs(trans - predictions), SAMPLES))
-        cols["mse"].append(trapezoid((trans - predictions) ** 2, SAMPLES))
-        cols["weighted_mae"].append(trapezoid(supp * numpy.abs(trans - predictions), SAMPLES))
-        cols["weighted_mse"].append(trapezoid(supp * (trans - predictions) ** 2, SAMPLES))
-    df_out = pandas.DataFrame(cols)
+@click.argument("dfout", type=click.Path(), required=False)
+@click.option("--method", help="Method used for the fit if not recorded with it")
+@click.option("--workers", type=int, default=1)
+@click.option("--bw", default="normal_reference", help="normal_reference, lscv or a number")
+@click.option("--pooled-bw/--per-respondent-bw", default=False, help="Use one pair of LSCV bandwidths for the whole dataset")
+@click.option("--backend", type=click.Choice(BACKENDS), default="binned", help="Batched binned KDEs or statsmodels KDEs per respondent")
+def main(dfin, fitin, dfout, method, workers, bw, pooled_bw, backend):
+    if method is None:
+        method = read_fit_method(fitin)
+    if method is None:
+        raise click.UsageError(f"No method recorded in {fitin}: pass --method")
+    fit_conf = method_regression_config(method)
+    fit_df = pandas.read_parquet(fitin)
+    bw_kwargs = bandwidth_kwargs(dfin, bw, pooled_bw)
+    if workers <= 1:
+        df_out = shard_deviance(dfin, fit_df, fit_conf, bw_kwargs=bw_kwargs, backend=backend)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        shards = split_respondents(respondent_sizes(dfin), workers)
+        with ProcessPoolExecutor(workers) as executor:
+            futures = [
+                executor.submit(shard_deviance, dfin, fit_df, fit_conf, shard_resps, bw_kwargs, backend)
+                for shard_resps in shards
+            ]
+            df_out = pandas.concat(
+                [future.result() for future in futures],
+                ignore_index=True
+            )
     print(df_out)
-    print(df_out.mean())
+    print(df_out[METRICS].mean())
+    if dfout is not None:
+        df_out.to_parquet(dfout)
 
 
 if __name__ == "__main__":
@@ -2,50 +2,94 @@ import click
 import scipy
 import pandas as pd
 import numpy as np
-from .nonparametric import NonParametricEstimator
+from .nonparametric import bandwidth_kwargs, chunk_estimator
 from .transfer_curves import inv_cloglog
+from ..dataset import iter_chunks, respondent_sizes
+from ..parametric.regress import split_respondents
 from matplotlib import pyplot as plt
 
 
 NUM_SAMPLE_POINTS = 2048
 TRANSFER_X = np.linspace(-10, 10, NUM_SAMPLE_POINTS)
+DATA_COLUMNS = ["zipf", "known"]
 
 
-def resample_nonparameteric(df, x_in, x_out):
-    groups = df.groupby("respondent")
-    x_series = pd.Series(x_in)
+class TransferCurve:
+    """
+    A transfer curve evaluated once on a grid and then linearly
+    interpolated, along with its derivative. Only grid points with support
+    (NonParametricResult.supported()) are interpolated between, and beyond
+    them the curve is held at the value of the nearest one.
+    """
+    def __init__(self, grid, transfer):
+        valid = np.isfinite(transfer)
+        self.grid = grid[valid]
+        self.y = transfer[valid]
+        self.dy = np.gradient(self.y, self.grid)
+
+    def __call__(self, x):
+        return np.interp(x, self.grid, self.y)
+
+    def deriv(self, x):
+        return np.interp(x, self.grid, self.dy, left=0, right=0)
+
+
+def resample_nonparameteric(chunks, x_in, x_out, bw_kwargs=None):
+    respondents = []
     curves = []
-    for resp_idx, df_resp in groups:
-        est = NonParametricEstimator.from_df(df_resp, "zipf", "known")
-        transformed_curve = get_overlay(x_in, x_out, inv_cloglog, est)
-        #curve = est.evaluate(x).transfer()
-        #curves.append(curve)
-        if transformed_curve is None:
-            continue
-        curves.append(transformed_curve)
-    return pd.DataFrame(curves, columns=x_series)
-
-
-def mk_curve_transformer(estimator):
+    for chunk in chunks:
+        est = chunk_estimator(chunk, **(bw_kwargs or {}))
+        # NaN away from each respondent's data
+        transfers = est.evaluate(TRANSFER_X).transfer()
+        for resp_idx, transfer in zip(est.groups, transfers):
+            if not np.isfinite(transfer).any():
+                print(f"No transfer curve for {resp_idx}")
+                continue
+            curve = TransferCurve(TRANSFER_X, transfer)
+            transformed_curve = get_overlay(x_in, x_out, inv_cloglog, curve)
+            if transformed_curve is None:
+                continue
+            respondents.append(resp_idx)
+            curves.append(transformed_curve)
+    return respondents, curves
+
+
+def resample_shard(dfin, x_in, x_out, respondents=None, bw_kwargs=None):
+    return resample_nonparameteric(
+        iter_chunks(dfin, DATA_COLUMNS, respondents, allow_dense=True),
+        x_in,
+        x_out,
+        bw_kwargs
+    )
+
+
+def mk_curve_transformer(curve):
     def transformed_curve(x, x_shift, x_scale, y_offset):
         return (
             y_offset
             + (1 - y_offset)
-            * estimator.evaluate(x_scale * x - x_shift).transfer()
+            * curve(x_scale * x - x_shift)
         )
     return transformed_curve
 
 
-def get_overlay(x_in, x_out, trans_func, estimator):
-    transformed_curve = mk_curve_transformer(estimator)
-    #support = estimator.evaluate(x_in).support()
+def mk_curve_jacobian(curve):
+    def curve_jacobian(x, x_shift, x_scale, y_offset):
+        u = x_scale * x - x_shift
+        d_curve = (1 - y_offset) * curve.deriv(u)
+        return np.stack([-d_curve, d_curve * x, 1 - curve(u)], axis=1)
+    return curve_jacobian
+
+
+def get_overlay(x_in, x_out, trans_func, curve):
+    transformed_curve = mk_curve_transformer(curve)
     try:
         popt, pcov = scipy.optimize.curve_fit(
-            mk_curve_transformer(estimator),
+            transformed_curve,
             x_in,
             trans_func(x_in),
             (0, 1, 0),
-            #sigma=1 / np.sqrt(support),
+            jac=mk_curve_jacobian(curve),
             absolute_sigma=True
         )
         return transformed_curve(x_out, *popt)
@@ -63,11 +107,31 @@ def plot_mpl(std_x, resampled_df, imgout):
 @click.command()
 @click.argument("dfin", type=click.Path(exists=True))
 @click.argument("imgout")
-def main(dfin, imgout):
-    df = pd.read_parquet(dfin)
+@click.option("--workers", type=int, default=1)
+@click.option("--bw", default="normal_reference", help="normal_reference, lscv or a number")
+@click.option("--pooled-bw/--per-respondent-bw", default=False, help="Use one pair of LSCV bandwidths for the whole dataset")
+def main(dfin, imgout, workers, bw, pooled_bw):
     zipf_x = np.linspace(0, 7, NUM_SAMPLE_POINTS)
     std_x = np.linspace(0, 1, NUM_SAMPLE_POINTS)
-    resampled_df = resample_nonparameteric(df, zipf_x, std_x)
+    bw_kwargs = bandwidth_kwargs(dfin, bw, pooled_bw)
+    if workers <= 1:
+        respondents, curves = resample_shard(dfin, zipf_x, std_x, bw_kwargs=bw_kwargs)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        shards = split_respondents(respondent_sizes(dfin), workers)
+        respondents = []
+        curves = []
+        with ProcessPoolExecutor(workers) as executor:
+            futures = [
+                executor.submit(resample_shard, dfin, zipf_x, std_x, shard_resps, bw_kwargs)
+                for shard_resps in shards
+            ]
+            for future in futures:
+                shard_respondents, shard_curves = future.result()
+                respondents.extend(shard_respondents)
+                curves.extend(shard_curves)
+    resampled_df = pd.DataFrame(curves, index=respondents, columns=pd.Series(std_x))
     plot_mpl(std_x, resampled_df, imgout)
 
 
@@ -0,0 +1,94 @@
+from dataclasses import dataclass
+from enum import Enum
+import numpy
+from scipy import stats as ss
+
+from .transfer_curves import inv_cloglog
+
+
+class LinkFunc(Enum):
+    LOGIT = 1
+    PROBIT = 2
+    CLOGLOG = 3
+
+
+LINKS = {
+    LinkFunc.LOGIT: ss.logistic.cdf,  # lambda x: 1 / (1 + numpy.exp(-x)),
+    LinkFunc.PROBIT: ss.norm.cdf,
+    LinkFunc.CLOGLOG: inv_cloglog,
+}
+
+
+@dataclass
+class RegressionConfig:
+    pred_unk: bool = False
+    link: LinkFunc = LinkFunc.LOGIT
+    zi: bool = False
+    oi: bool = False
+
+
+OI_CONF = RegressionConfig(oi=True)
+
+
+def method_regression_config(method):
+    """
+    Guess the RegressionConfig of a regress.py/regress.R method from its
+    name, e.g. statsmodelsGlmProbit, mleZiCloglog or stanLogit.
+    """
+    link = LinkFunc.LOGIT
+    for suffix, link_func in [
+        ("Logit", LinkFunc.LOGIT),
+        ("Probit", LinkFunc.PROBIT),
+        ("Cloglog", LinkFunc.CLOGLOG),
+    ]:
+        if method.endswith(suffix):
+            link = link_func
+    zi = "Zi" in method
+    oi = "Oi" in method or method.startswith("stan")
+    return RegressionConfig(link=link, zi=zi, oi=oi)
+
+
+def reg_curves(fit_conf, const_coef, zipf_coef, phi_coef, x):
+    """
+    Regression curves for arrays of coefficients, broadcasting against x.
+    """
+    assert not fit_conf.pred_unk
+    link = LINKS[fit_conf.link]
+    theta = x * zipf_coef + const_coef
+    y_uninflated = link(theta)
+    if fit_conf.oi or fit_conf.zi:
+        inflate_prob = LINKS[LinkFunc.LOGIT](phi_coef)
+        if fit_conf.oi:
+            assert not fit_conf.zi
+            return inflate_prob + (1 - inflate_prob) * y_uninflated
+        else:
+            return (1 - inflate_prob) * y_uninflated
+    else:
+        return y_uninflated
+
+
+# Columns of cumulative link fits holding the intercept of each threshold
+THRESHOLD_PREFIX = "const_coef_"
+
+
+def sample_cumulative_curves(fit_conf, fit_row, x):
+    """
+    The curves P(score >= level) of every threshold of a cumulative link fit
+    from regress.py.
+    """
+    plain_conf = RegressionConfig(link=fit_conf.link)
+    return [
+        reg_curves(plain_conf, fit_row[col].iloc[0], fit_row["zipf_coef"].iloc[0], None, x)
+        for col in fit_row.columns
+        if col.startswith(THRESHOLD_PREFIX)
+    ]
+
+
+def sample_reg_curve(fit_conf, fit_row, x):
+    return reg_curves(
+        fit_conf,
+        fit_row["const_coef"].iloc[0],
+        fit_row["zipf_coef"].iloc[0],
+        fit_row["phi_coef"].iloc[0] if (fit_conf.oi or fit_conf.zi) else None,
+        x
+    )
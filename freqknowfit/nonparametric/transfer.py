@@ -1,63 +1,36 @@
-from dataclasses import dataclass
-from enum import Enum
 import click
 import numpy
 import pandas
 import seaborn as sns
 from matplotlib import pyplot as plt, rcParams
-from scipy import stats as ss
 from math import ceil
+from os.path import isdir, splitext
 
-from .nonparametric import NonParametricEstimator
+from .nonparametric import (
+    NonParametricEstimator,
+    OrdinalNonParametricEstimator,
+    bandwidth_kwargs,
+)
+from .regression import (
+    OI_CONF,
+    method_regression_config,
+    sample_cumulative_curves,
+    sample_reg_curve,
+)
 from .utils import zip_fits
+from ..dataset import read_dataset, respondent_sizes
+from ..parametric.results import read_fit_method
 
 # from statsmodels.nonparametric.smoothers_lowess import lowess
 
 
-class LinkFunc(Enum):
-    LOGIT = 1
-    PROBIT = 2
-    CLOGLOG = 3
-
-
-LINKS = {
-    LinkFunc.LOGIT: ss.logistic.cdf,  # lambda x: 1 / (1 + numpy.exp(-x)),
-    LinkFunc.PROBIT: ss.norm.cdf,
-    LinkFunc.CLOGLOG: lambda x: numpy.log(-numpy.log(1 - x))
-}
-
-
-@dataclass
-class RegressionConfig:
-    pred_unk: bool = False
-    link: LinkFunc = LinkFunc.LOGIT
-    zi: bool = False
-    oi: bool = False
-
-
-OI_CONF = RegressionConfig(oi=True)
+DATA_COLUMNS = ["zipf", "known", "score"]
 NUM_SAMPLE_POINTS = 2048
 ZIPF_X = numpy.linspace(0, 7.5, NUM_SAMPLE_POINTS)
 
 
-def sample_reg_curve(fit_conf, fit_row, x):
-    assert not fit_conf.pred_unk
-    link = LINKS[fit_conf.link]
-    theta = x * fit_row["zipf_coef"].iloc[0] + fit_row["const_coef"].iloc[0]
-    y_uninflated = link(theta)
-    if fit_conf.oi or fit_conf.zi:
-        inflate_prob = LINKS[LinkFunc.LOGIT](fit_row["phi_coef"].iloc[0])
-        if fit_conf.oi:
-            assert not fit_conf.zi
-            return inflate_prob + (1 - inflate_prob) * y_uninflated
-        else:
-            return (1 - inflate_prob) * y_uninflated
-    else:
-        return y_uninflated
-
-
-def regplot(ax, x, y, data, fit_conf, fit_row):
-    ax.scatter(data[x], data[y])
+def regplot(ax, x, y, data, fit_conf, fit_row, rasterized=False):
+    ax.scatter(data[x], data[y], rasterized=rasterized)
     ax.plot(ZIPF_X, sample_reg_curve(fit_conf, fit_row, ZIPF_X))
 
 # sns.regplot(
@@ -70,52 +43,96 @@ def regplot(ax, x, y, data, fit_conf, fit_row):
 # )
 
 
-def plot_nonparametric_fit(df_resp, ax, ordinal=False, bw="normal_reference", add_support=False):
+def plot_transfer(nonparametric_est, ax, bootstrap=0, confidence=0.95, seed=0, bootstrap_workers=1):
+    est_result = nonparametric_est.evaluate(ZIPF_X)
+    sns.lineplot(x=ZIPF_X, y=est_result.transfer(), ax=ax)
+    if bootstrap:
+        bands = nonparametric_est.bootstrap(
+            ZIPF_X,
+            bootstrap,
+            confidence=confidence,
+            seed=seed,
+            workers=bootstrap_workers
+        )
+        ax.fill_between(ZIPF_X, bands.lo, bands.hi, alpha=0.3, linewidth=0)
+    return est_result
+
+
+def plot_ordinal_transfers(ordinal_est, ax, bootstrap=0, confidence=0.95, seed=0, bootstrap_workers=1):
+    est_result = ordinal_est.evaluate(ZIPF_X)
+    bands = None
+    if bootstrap:
+        bands = ordinal_est.bootstrap(
+            ZIPF_X,
+            bootstrap,
+            confidence=confidence,
+            seed=seed,
+            workers=bootstrap_workers
+        )
+    for idx, transfer in enumerate(est_result.transfers()[0]):
+        sns.lineplot(x=ZIPF_X, y=transfer, ax=ax)
+        if bands is not None:
+            ax.fill_between(ZIPF_X, bands.lo[idx], bands.hi[idx], alpha=0.3, linewidth=0)
+    return est_result
+
+
+def plot_nonparametric_fit(df_resp, ax, ordinal=False, bw="normal_reference", add_support=False, unknown_bw=None, **bootstrap_kwargs):
     if ordinal:
-        for score in sorted(df_resp["score"].unique())[1:]:
-            nonparametric_est = NonParametricEstimator(df_resp["zipf"], df_resp["score"] >= score, bw=bw)
-            est_result = nonparametric_est.evaluate(ZIPF_X)
-            sns.lineplot(x=ZIPF_X, y=est_result.transfer(), ax=ax)
+        # The score levels aren't split into known and unknown so unknown_bw
+        # doesn't apply
+        ordinal_est = OrdinalNonParametricEstimator.from_df(df_resp, bw=bw)
+        support = plot_ordinal_transfers(ordinal_est, ax, **bootstrap_kwargs).support()[0]
     else:
         nonparametric_est = NonParametricEstimator.from_df(
             df_resp,
             "zipf",
             "known",
-            bw=bw
+            bw=bw,
+            unknown_bw=unknown_bw
         )
-        est_result = nonparametric_est.evaluate(ZIPF_X)
-        sns.lineplot(x=ZIPF_X, y=est_result.transfer(), ax=ax)
+        support = plot_transfer(nonparametric_est, ax, **bootstrap_kwargs).support()
     if add_support:
-        sns.lineplot(x=ZIPF_X, y=est_result.support(), ax=ax)
+        sns.lineplot(x=ZIPF_X, y=support, ax=ax)
+
+
+def scaled_scores(df_resp):
+    min_score = df_resp["score"].min()
+    max_score = df_resp["score"].max()
+    return (df_resp["score"] - min_score) / (max_score - min_score)
 
 
-def draw_plot_using_fit(df_resp, fit_conf, fit_row, ax, ordinal=False, bw="normal_reference", add_support=False, add_kde=True):
-    assert not ordinal
+def draw_plot_using_fit(df_resp, fit_conf, fit_row, ax, ordinal=False, bw="normal_reference", add_support=False, add_kde=True, rasterized=False, **kde_kwargs):
     if add_kde:
-        plot_nonparametric_fit(df_resp, ax, ordinal=ordinal, bw=bw, add_support=add_support)
+        plot_nonparametric_fit(df_resp, ax, ordinal=ordinal, bw=bw, add_support=add_support, **kde_kwargs)
+    if ordinal:
+        ax.scatter(df_resp["zipf"], scaled_scores(df_resp), rasterized=rasterized)
+        for curve in sample_cumulative_curves(fit_conf, fit_row, ZIPF_X):
+            ax.plot(ZIPF_X, curve)
+        return
     regplot(
         x="zipf", y="known", data=df_resp, ax=ax,
-        fit_conf=fit_conf, fit_row=fit_row
+        fit_conf=fit_conf, fit_row=fit_row, rasterized=rasterized
     )
 
 
-def draw_plot(df_resp, ax, create_fit=True, ordinal=False, datapoints="none", bw="normal_reference", add_support=False, add_kde=True):
+def draw_plot(df_resp, ax, create_fit=True, ordinal=False, datapoints="none", bw="normal_reference", add_support=False, add_kde=True, rasterized=False, **kde_kwargs):
     if add_kde:
-        plot_nonparametric_fit(df_resp, ax, ordinal=ordinal, bw=bw, add_support=add_support)
+        plot_nonparametric_fit(df_resp, ax, ordinal=ordinal, bw=bw, add_support=add_support, **kde_kwargs)
     if create_fit:
         assert not ordinal
-        sns.regplot(x="zipf", y="known", data=df_resp, ax=ax, logistic=True, ci=None)
+        sns.regplot(
+            x="zipf", y="known", data=df_resp, ax=ax, logistic=True, ci=None,
+            scatter_kws={"rasterized": rasterized}
+        )
     else:
         if ordinal:
-            min_score = df_resp["score"].min()
-            max_score = df_resp["score"].max()
-            y = (df_resp["score"] - min_score) / (max_score - min_score)
+            y = scaled_scores(df_resp)
         else:
             y = df_resp["known"]
         if datapoints == "stripplot":
-            sns.stripplot(x=df_resp["zipf"], y=y, size=1, jitter=5000)
+            sns.stripplot(x=df_resp["zipf"], y=y, size=1, jitter=5000, ax=ax, rasterized=rasterized)
         elif datapoints == "scatterplot":
-            ax.scatter(x=df_resp["zipf"], y=y)
+            ax.scatter(x=df_resp["zipf"], y=y, rasterized=rasterized)
 
 
 def mk_subplots(num_plots, size_inches=4):
@@ -126,6 +143,87 @@ def mk_subplots(num_plots, size_inches=4):
     return fig, (ax.flatten() if isinstance(ax, numpy.ndarray) else [ax])
 
 
+def draw_respondents(df, ax_flat, fit_df=None, fit_conf=OI_CONF, progress_start=0, progress_total=None, **kwargs):
+    resp_grouped = df.groupby("respondent")
+    if progress_total is None:
+        progress_total = len(resp_grouped)
+    if fit_df is not None:
+        draw_kwargs = {
+            k: v for k, v in kwargs.items()
+            if k not in ("create_fit", "datapoints")
+        }
+        for resp_idx, (resp_ax, (resp_id, df_resp, fit_row)) in \
+                enumerate(zip(ax_flat, zip_fits(resp_grouped, fit_df))):
+            progress = f"{progress_start + resp_idx + 1}/{progress_total}"
+            print(f"Plotting {progress} ({resp_id})")
+            draw_plot_using_fit(df_resp, fit_conf, fit_row, resp_ax, **draw_kwargs)
+    else:
+        for resp_idx, (resp_ax, (resp_id, df_resp)) in \
+                enumerate(zip(ax_flat, resp_grouped)):
+            progress = f"{progress_start + resp_idx + 1}/{progress_total}"
+            print(f"Plotting {progress} ({resp_id})")
+            draw_plot(df_resp, resp_ax, **kwargs)
+
+
+def page_path(imgout, page_idx):
+    base, ext = splitext(imgout)
+    return f"{base}-{page_idx + 1:04d}{ext}"
+
+
+def render_page(dfin, respondents, imgout, fit_df, fit_conf, size_inches, progress_start, progress_total, draw_kwargs):
+    plt.switch_backend("Agg")
+    df = read_dataset(dfin, DATA_COLUMNS, respondents)
+    if fit_df is not None:
+        fit_df = fit_df[fit_df["respondent"].astype(str).isin([str(r) for r in respondents])]
+    fig, ax_flat = mk_subplots(len(respondents), size_inches)
+    draw_respondents(
+        df,
+        ax_flat,
+        fit_df=fit_df,
+        fit_conf=fit_conf,
+        progress_start=progress_start,
+        progress_total=progress_total,
+        **draw_kwargs
+    )
+    fig.tight_layout()
+    fig.savefig(imgout)
+    plt.close(fig)
+    return imgout
+
+
+def render_pages(dfin, respondents, imgout, per_page, workers, fit_df, fit_conf, size_inches, draw_kwargs):
+    pages = [
+        respondents[page_start:page_start + per_page]
+        for page_start in range(0, len(respondents), per_page)
+    ]
+    args = [
+        (
+            dfin,
+            page_resps,
+            page_path(imgout, page_idx),
+            fit_df,
+            fit_conf,
+            size_inches,
+            page_idx * per_page,
+            len(respondents),
+            draw_kwargs,
+        )
+        for page_idx, page_resps in enumerate(pages)
+    ]
+
+    def report(results):
+        for page_idx, page_out in enumerate(results):
+            print(f"Rendered page {page_idx + 1}/{len(pages)}: {page_out}")
+
+    if workers <= 1:
+        report(render_page(*page_args) for page_args in args)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(workers) as executor:
+            report(executor.map(render_page, *zip(*args)))
+
+
 @click.command()
 @click.argument("dfin", type=click.Path(exists=True))
 @click.argument("imgout")
@@ -136,8 +234,15 @@ def mk_subplots(num_plots, size_inches=4):
 @click.option("--add-support/--no-support")
 @click.option("--no-add-kde/--add-kde")
 @click.option("--respondent", multiple=True)
-@click.option("--bw", default="normal_reference")
+@click.option("--bw", default="normal_reference", help="A KDEUnivariate bandwidth, lscv or a number")
+@click.option("--pooled-bw/--per-respondent-bw", default=False, help="Use one pair of LSCV bandwidths for the whole dataset")
 @click.option("--size-inches", type=int, default=4)
+@click.option("--per-page", type=int, help="Write pages of this many respondents to IMGOUT-0001.ext, ...")
+@click.option("--workers", type=int, default=1)
+@click.option("--rasterize/--no-rasterize", default=False)
+@click.option("--bootstrap", type=int, default=0, help="Number of bootstrap replicates for confidence bands around the KDE transfer curves")
+@click.option("--confidence", type=float, default=0.95)
+@click.option("--seed", type=int, default=0)
 def main(
     dfin,
     imgout,
@@ -149,41 +254,59 @@ def main(
     no_add_kde,
     respondent,
     bw,
-    size_inches
+    pooled_bw,
+    size_inches,
+    per_page,
+    workers,
+    rasterize,
+    bootstrap,
+    confidence,
+    seed
 ):
-    if bw[0].isnumeric():
-        bw = float(bw)
-    df = pandas.read_parquet(dfin)
+    bw_kwargs = bandwidth_kwargs(dfin, bw, pooled_bw)
     if respondent:
         if respondent[0].isnumeric():
             respondent = [int(r) for r in respondent]
+        found = set(respondent_sizes(dfin, respondent).index)
         for r in respondent:
-            if not (df["respondent"] == r).any():
+            if r not in found:
                 raise click.ClickException(f"Respondent not found: {r}")
-        df = df[df["respondent"].isin(respondent)]
-    resp_grouped = df.groupby("respondent")
-    fig, ax_flat = mk_subplots(len(resp_grouped), size_inches)
+        respondents = sorted(found)
+    else:
+        respondents = respondent_sizes(dfin).index.to_list()
+    fit_df = None
+    fit_conf = OI_CONF
     if fit is not None:
         fit_df = pandas.read_parquet(fit)
         if respondent:
-            fit_df = fit_df[fit_df["respondent"].isin(respondent)]
-        for resp_idx, (resp_ax, (resp_id, df_resp, fit_row)) in \
-                enumerate(zip(ax_flat, zip_fits(resp_grouped, fit_df))):
-            progress = f"{resp_idx + 1}/{len(fitted_resps)}"
-            print(f"Plotting {progress} ({resp_id})")
-            print(df_resp)
-            draw_plot_using_fit(df_resp, OI_CONF, fit_row, resp_ax, ordinal=ordinal, bw=bw, add_support=add_support, add_kde=not no_add_kde)
-            print(f"Done {progress}")
+            fit_df = fit_df[fit_df["respondent"].astype(str).isin([str(r) for r in respondent])]
+        fit_method = read_fit_method(fit) if isdir(fit) else None
+        if fit_method is not None:
+            fit_conf = method_regression_config(fit_method)
+    draw_kwargs = dict(
+        create_fit=not no_add_fit,
+        ordinal=ordinal,
+        datapoints=datapoints,
+        **bw_kwargs,
+        add_support=add_support,
+        add_kde=not no_add_kde,
+        rasterized=rasterize,
+        bootstrap=bootstrap,
+        confidence=confidence,
+        seed=seed,
+        # Pages are already spread over the workers
+        bootstrap_workers=workers if per_page is None else 1,
+    )
+    if per_page is None:
+        render_page(
+            dfin, respondents, imgout, fit_df, fit_conf, size_inches, 0,
+            len(respondents), draw_kwargs
+        )
     else:
-        for resp_idx, (resp_ax, (resp_id, df_resp)) in \
-                enumerate(zip(ax_flat, resp_grouped)):
-            progress = f"{resp_idx + 1}/{len(resp_grouped)}"
-            print(f"Plotting {progress} ({resp_id})")
-            print(df_resp)
-            draw_plot(df_resp, resp_ax, create_fit=not no_add_fit, ordinal=ordinal, datapoints=datapoints, bw=bw, add_support=add_support, add_kde=not no_add_kde)
-            print(f"Done {progress}")
-    fig.tight_layout()
-    plt.savefig(imgout)
+        render_pages(
+            dfin, respondents, imgout, per_page, workers, fit_df, fit_conf,
+            size_inches, draw_kwargs
+        )
 
 
 if __name__ == "__main__":
@@ -1,22 +1,27 @@
 import pandas
 
+from ..dataset import iter_respondents, respondent_sizes
+
 
 class IterFittedResps:
-    def __init__(self, dfin, fitin):
-        df = pandas.read_parquet(dfin)
+    def __init__(self, dfin, fitin, columns=None):
+        self.dfin = dfin
+        self.columns = columns
         self.fit_df = pandas.read_parquet(fitin)
-        self.groups = df.groupby("respondent")
 
     def __len__(self):
-        return len(self.groups)
+        return len(respondent_sizes(self.dfin))
 
     def __iter__(self):
-        yield from zip_fits(self.groups, self.fit_df)
+        yield from zip_fits(iter_respondents(self.dfin, self.columns), self.fit_df)
 
 
 def zip_fits(groups, fit_df):
+    # R writes respondents as strings so match on those
+    fit_resps = pandas.Index(fit_df["respondent"].astype(str))
     for resp_idx, df_resp in groups:
-        fit_row = fit_df[fit_df["respondent"] == str(resp_idx)]
-        if len(fit_row) != 1:
+        # -1 when missing, which iloc would take as the last row
+        positions = fit_resps.get_indexer_for([str(resp_idx)])
+        if len(positions) != 1 or positions[0] < 0:
             raise ValueError(f"Couldn't get fitted model for {resp_idx}")
-        yield resp_idx, df_resp, fit_row
+        yield resp_idx, df_resp, fit_df.iloc[positions]
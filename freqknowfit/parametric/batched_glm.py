@@ -0,0 +1,284 @@
+"""
+Binary GLMs fitted with IRLS on all respondents at once. Respondents are
+stacked into flat arrays indexed by an integer code and each WLS step is
+reduced to per-respondent weighted sums. The iteration and the separation
+check mirror statsmodels' GLM._fit_irls so results agree with
+fit_statsmodels.
+"""
+from dataclasses import dataclass
+import numpy
+import pandas
+
+from .links import LINKS, TINY, clean
+
+
+PERFECT_SEPARATION_TOL = 1e-8
+
+
+@dataclass
+class IrlsResult:
+    params: numpy.ndarray
+    cov: numpy.ndarray
+    deviance: numpy.ndarray
+    nobs: numpy.ndarray
+    iterations: numpy.ndarray
+    converged: numpy.ndarray
+    separated: numpy.ndarray
+    degenerate: numpy.ndarray
+
+    @property
+    def ok(self):
+        return ~(self.separated | self.degenerate)
+
+
+def unit_deviance(y, mu):
+    mu = clean(mu)
+    return -2 * (y * numpy.log(mu) + (1 - y) * numpy.log1p(-mu))
+
+
+def group_extent(codes, num_groups, x):
+    x_min = numpy.full(num_groups, numpy.inf)
+    x_max = numpy.full(num_groups, -numpy.inf)
+    numpy.minimum.at(x_min, codes, x)
+    numpy.maximum.at(x_max, codes, x)
+    return x_min, x_max
+
+
+def solve_wls(sums):
+    sw, swx, swxx, swz, swxz = sums
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        det = sw * swxx - swx ** 2
+        params = numpy.stack([
+            (swxx * swz - swx * swxz) / det,
+            (sw * swxz - swx * swz) / det,
+        ], axis=1)
+        cov = numpy.stack([
+            numpy.stack([swxx, -swx], axis=1),
+            numpy.stack([-swx, sw], axis=1),
+        ], axis=1) / det[:, None, None]
+    return params, cov
+
+
+def irls(codes, num_groups, x, y, link, start=None, maxiter=100, tol=1e-8):
+    """
+    Fit y ~ 1 + x with a binomial family for each group in codes.
+
+    Groups start from the (num_groups, 2) coefficients start where they are
+    finite, like start_params in statsmodels, and otherwise from the data.
+    Groups which have converged, or have been found to be perfectly
+    separated, are masked out of subsequent iterations.
+    """
+    link = LINKS[link] if isinstance(link, str) else link
+
+    def group_sum(group_codes, weights):
+        return numpy.bincount(group_codes, weights=weights, minlength=num_groups)
+
+    nobs = numpy.bincount(codes, minlength=num_groups)
+    x_min, x_max = group_extent(codes, num_groups, x)
+    # statsmodels' add_constant(...) skips the constant when zipf is itself
+    # constant, which leaves fewer than 2 parameters
+    degenerate = ~(x_max > x_min)
+
+    mu = (y + 0.5) / 2
+    eta = link.link(mu)
+    if start is not None:
+        start = numpy.asarray(start, dtype=float)[:, :2]
+        warm = numpy.isfinite(start).all(axis=1)[codes]
+        eta[warm] = start[codes[warm], 0] + start[codes[warm], 1] * x[warm]
+        mu = link.inverse(eta)
+    deviance = group_sum(codes, unit_deviance(y, mu))
+    params = numpy.full((num_groups, 2), numpy.nan)
+    cov = numpy.full((num_groups, 2, 2), numpy.nan)
+    iterations = numpy.zeros(num_groups, dtype=numpy.int64)
+    converged = numpy.zeros(num_groups, dtype=bool)
+    separated = numpy.zeros(num_groups, dtype=bool)
+    active = ~degenerate
+
+    for _ in range(maxiter):
+        rows = active[codes]
+        if not rows.any():
+            break
+        group_codes = codes[rows]
+        x_act = x[rows]
+        y_act = y[rows]
+        eta_act = eta[rows]
+        mu_act = clean(link.inverse(eta_act))
+        dmu = numpy.maximum(link.inverse_deriv(eta_act), TINY)
+        weights = dmu ** 2 / (mu_act * (1 - mu_act))
+        z = eta_act + (y_act - mu_act) / dmu
+        new_params, new_cov = solve_wls((
+            group_sum(group_codes, weights),
+            group_sum(group_codes, weights * x_act),
+            group_sum(group_codes, weights * x_act ** 2),
+            group_sum(group_codes, weights * z),
+            group_sum(group_codes, weights * x_act * z),
+        ))
+        params[active] = new_params[active]
+        cov[active] = new_cov[active]
+        eta_act = params[group_codes, 0] + params[group_codes, 1] * x_act
+        eta[rows] = eta_act
+        mu_act = link.inverse(eta_act)
+        new_deviance = group_sum(group_codes, unit_deviance(y_act, mu_act))
+        misfits = group_sum(
+            group_codes,
+            numpy.abs(mu_act - y_act) > PERFECT_SEPARATION_TOL
+        )
+        iterations[active] += 1
+        newly_separated = active & (misfits == 0)
+        newly_converged = (
+            active
+            & ~newly_separated
+            & (numpy.abs(new_deviance - deviance) <= tol)
+        )
+        deviance[active] = new_deviance[active]
+        separated |= newly_separated
+        converged |= newly_converged
+        active &= ~(newly_separated | newly_converged)
+
+    return IrlsResult(
+        params=params,
+        cov=cov,
+        deviance=deviance,
+        nobs=nobs,
+        iterations=iterations,
+        converged=converged,
+        separated=separated,
+        degenerate=degenerate,
+    )
+
+
+def irls_dense(x, y, link, start=None, maxiter=100, tol=1e-8):
+    """
+    irls(...) for groups which all share the same x, given y as a
+    (num_groups, len(x)) matrix. The weighted sums of each WLS step become
+    products with x.
+    """
+    link = LINKS[link] if isinstance(link, str) else link
+    num_groups, num_items = y.shape
+    nobs = numpy.full(num_groups, num_items)
+    degenerate = numpy.full(num_groups, not (num_items and x.max() > x.min()))
+    x_sq = x ** 2
+
+    mu = (y + 0.5) / 2
+    eta = link.link(mu)
+    if start is not None:
+        start = numpy.asarray(start, dtype=float)[:, :2]
+        warm = numpy.isfinite(start).all(axis=1)
+        eta[warm] = start[warm, :1] + start[warm, 1:] * x
+        mu = link.inverse(eta)
+    deviance = unit_deviance(y, mu).sum(axis=1)
+    params = numpy.full((num_groups, 2), numpy.nan)
+    cov = numpy.full((num_groups, 2, 2), numpy.nan)
+    iterations = numpy.zeros(num_groups, dtype=numpy.int64)
+    converged = numpy.zeros(num_groups, dtype=bool)
+    separated = numpy.zeros(num_groups, dtype=bool)
+    active = ~degenerate
+
+    for _ in range(maxiter):
+        rows = numpy.flatnonzero(active)
+        if not len(rows):
+            break
+        y_act = y[rows]
+        eta_act = eta[rows]
+        mu_act = clean(link.inverse(eta_act))
+        dmu = numpy.maximum(link.inverse_deriv(eta_act), TINY)
+        weights = dmu ** 2 / (mu_act * (1 - mu_act))
+        weighted_z = weights * (eta_act + (y_act - mu_act) / dmu)
+        new_params, new_cov = solve_wls((
+            weights.sum(axis=1),
+            weights @ x,
+            weights @ x_sq,
+            weighted_z.sum(axis=1),
+            weighted_z @ x,
+        ))
+        params[rows] = new_params
+        cov[rows] = new_cov
+        eta_act = new_params[:, :1] + new_params[:, 1:] * x
+        eta[rows] = eta_act
+        mu_act = link.inverse(eta_act)
+        new_deviance = unit_deviance(y_act, mu_act).sum(axis=1)
+        misfits = (numpy.abs(mu_act - y_act) > PERFECT_SEPARATION_TOL).sum(axis=1)
+        iterations[rows] += 1
+        newly_separated = misfits == 0
+        newly_converged = (
+            ~newly_separated
+            & (numpy.abs(new_deviance - deviance[rows]) <= tol)
+        )
+        deviance[rows] = new_deviance
+        separated[rows] = newly_separated
+        converged[rows] = newly_converged
+        active[rows] = ~(newly_separated | newly_converged)
+
+    return IrlsResult(
+        params=params,
+        cov=cov,
+        deviance=deviance,
+        nobs=nobs,
+        iterations=iterations,
+        converged=converged,
+        separated=separated,
+        degenerate=degenerate,
+    )
+
+
+def glm_cols(result):
+    ok = result.ok
+    n = result.nobs.astype(float)
+    llf = -result.deviance / 2
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        bse = numpy.sqrt(numpy.diagonal(result.cov, axis1=1, axis2=2))
+        cols = {
+            "const_coef": result.params[:, 0],
+            "zipf_coef": result.params[:, 1],
+            "const_err": bse[:, 0],
+            "zipf_err": bse[:, 1],
+            "aic": -2 * llf + 4,
+            # Same degrees of freedom as fit_statsmodels passes to aicc(...)
+            "aic_c": -2 * llf + 2 * n / (n - 2),
+            "bic_deviance": result.deviance - (n - 2) * numpy.log(n),
+            "bic_llf": -2 * llf + 2 * numpy.log(n),
+        }
+    return {k: numpy.where(ok, v, numpy.nan) for k, v in cols.items()}
+
+
+def failure_reasons(separated, degenerate):
+    return numpy.where(
+        degenerate,
+        "degenerate_zipf",
+        numpy.where(separated, "perfect_separation", None)
+    )
+
+
+def result_cols(result, respondents):
+    cols = glm_cols(result)
+    cols["respondent"] = respondents.to_numpy()
+    cols["iterations"] = result.iterations
+    cols["converged"] = result.converged
+    cols["failure"] = failure_reasons(result.separated, result.degenerate)
+    return cols
+
+
+def fit_batched_glm(df, link, start=None):
+    codes, respondents = pandas.factorize(df["respondent"], sort=True)
+    result = irls(
+        codes,
+        len(respondents),
+        df["zipf"].to_numpy(dtype=float),
+        df["known"].to_numpy(dtype=float),
+        link,
+        start=start
+    )
+    return result_cols(result, respondents)
+
+
+def fit_dense_glm(dense, link, start=None):
+    """
+    fit_batched_glm(...) for freqknowfit.dense.DenseResponses.
+    """
+    result = irls_dense(
+        dense.zipf,
+        dense.known.astype(float),
+        link,
+        start=start
+    )
+    return result_cols(result, dense.respondents)
@@ -1,6 +1,16 @@
 import click
 import pandas
 import numpy
+from os.path import join as pjoin, relpath
+
+from ..dataset import quote_literal
+from .results import list_runs, path_params, read_fit_method
+
+
+BOOTSTRAP_BLOCK = 64
+# Differences at most this big are ties, e.g. the same model fitted by
+# different code
+DEFAULT_TIE_TOL = 1e-6
 
 
 def nan_info(treatment, aics):
@@ -8,26 +18,210 @@ def nan_info(treatment, aics):
     print(f"Treatment {treatment} NaNs: {nan_count}; {nan_count/len(aics)}")
 
 
-@click.command()
+class DefaultToPair(click.Group):
+    """
+    Treats the original `compare_aics MEASURE TREAT1 TREAT2` form as the
+    pair command.
+    """
+    def parse_args(self, ctx, args):
+        if args and args[0] not in self.commands and not args[0].startswith("-"):
+            args = ["pair", *args]
+        return super().parse_args(ctx, args)
+
+
+@click.group(cls=DefaultToPair)
+def main():
+    pass
+
+
+@main.command()
 @click.argument("measure")
 @click.argument("treat1", type=click.Path(exists=True))
 @click.argument("treat2", type=click.Path(exists=True))
-def main(measure, treat1, treat2):
-    df1 = pandas.read_parquet(treat1)
-    df2 = pandas.read_parquet(treat2)
-    aics1 = df1[measure].to_numpy()
-    aics2 = df2[measure].to_numpy()
-    if len(aics1) != len(aics2):
-        print(f"WARNING: Lengths of treat1 and treat2 differ ({len(aics1)} vs {len(aics2)})")
-        print("Truncating to shortest")
-        trunk_len = min(len(aics1), len(aics2))
-        aics1 = aics1[:trunk_len]
-        aics2 = aics2[:trunk_len]
+def pair(measure, treat1, treat2):
+    """
+    Compare MEASURE between two fits of the same dataset.
+    """
+    df1 = pandas.read_parquet(treat1, columns=["respondent", measure])
+    df2 = pandas.read_parquet(treat2, columns=["respondent", measure])
+    # R writes respondents as strings so match on those
+    for df in [df1, df2]:
+        df["respondent"] = df["respondent"].astype(str)
+    merged = df1.merge(df2, on="respondent", how="outer", suffixes=("1", "2"), indicator=True)
+    if (merged["_merge"] != "both").any():
+        counts = merged["_merge"].value_counts()
+        print(
+            f"WARNING: {counts['left_only']} respondents only in treat1 and "
+            f"{counts['right_only']} only in treat2; comparing the rest"
+        )
+        merged = merged[merged["_merge"] == "both"]
+    aics1 = merged[measure + "1"].to_numpy(dtype=float)
+    aics2 = merged[measure + "2"].to_numpy(dtype=float)
     nan_info(1, aics1)
     nan_info(2, aics2)
     print("Treatment 1 has lower AIC {:.2f}".format(100 * (aics1 < aics2).mean()))
     print("Treatment 2 has lower AIC {:.2f}".format(100 * (aics2 < aics1).mean()))
 
 
+def quote_ident(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def register_fits(con, work, measure):
+    """
+    Create a view fits(model, dataset, respondent, value) over measure in
+    every complete results directory under work. NaNs become NULLs.
+    Nothing is read until the view is queried.
+    """
+    selects = []
+    for run in list_runs(work):
+        params = path_params(relpath(run, work))
+        model = read_fit_method(run) or params.get("model", relpath(run, work))
+        dataset = params.get("dataset", "")
+        source = f"read_parquet({quote_literal(pjoin(run, '*.parquet'))})"
+        columns = con.execute(f"DESCRIBE SELECT * FROM {source}").df()["column_name"]
+        if measure not in set(columns):
+            print(f"Skipping {run}: no {measure} column")
+            continue
+        value = f"CAST({quote_ident(measure)} AS DOUBLE)"
+        selects.append(
+            f"SELECT {quote_literal(model)} AS model, "
+            f"{quote_literal(dataset)} AS dataset, "
+            # R writes respondents as strings so match on those
+            "CAST(respondent AS VARCHAR) AS respondent, "
+            f"CASE WHEN isnan({value}) THEN NULL ELSE {value} END AS value "
+            f"FROM {source}"
+        )
+    if not selects:
+        return False
+    con.execute("CREATE VIEW fits AS " + " UNION ALL ".join(selects))
+    return True
+
+
+PAIRS_SQL = """
+WITH counts AS (
+    SELECT dataset, model, count(*) AS respondents
+    FROM fits
+    GROUP BY dataset, model
+), paired AS (
+    SELECT
+        a.dataset,
+        a.model AS model1,
+        b.model AS model2,
+        a.value AS value1,
+        b.value AS value2,
+        a.value - b.value AS delta
+    FROM fits a
+    JOIN fits b
+        ON a.dataset = b.dataset
+        AND a.respondent = b.respondent
+        AND a.model < b.model
+)
+SELECT
+    paired.dataset,
+    model1,
+    model2,
+    c1.respondents AS model1_respondents,
+    c2.respondents AS model2_respondents,
+    count(*) AS respondents,
+    count(delta) AS both_valid,
+    avg(CAST(value1 IS NULL AS DOUBLE)) AS model1_nan_rate,
+    avg(CAST(value2 IS NULL AS DOUBLE)) AS model2_nan_rate,
+    avg(CASE WHEN delta < -$tie_tol THEN 1.0 WHEN delta IS NOT NULL THEN 0.0 END) AS model1_win_rate,
+    avg(CASE WHEN delta > $tie_tol THEN 1.0 WHEN delta IS NOT NULL THEN 0.0 END) AS model2_win_rate,
+    avg(delta) AS delta_mean,
+    median(delta) AS delta_median,
+    quantile_cont(delta, 0.05) AS delta_q05,
+    quantile_cont(delta, 0.95) AS delta_q95
+FROM paired
+JOIN counts c1 ON c1.dataset = paired.dataset AND c1.model = model1
+JOIN counts c2 ON c2.dataset = paired.dataset AND c2.model = model2
+GROUP BY paired.dataset, model1, model2, c1.respondents, c2.respondents
+ORDER BY paired.dataset, model1, model2
+"""
+
+
+def bootstrap_means(values, num_samples, rng):
+    """
+    Poisson bootstrap replicates of the means of each row of values, as a
+    (num_samples, len(values)) array. Replicates are drawn in blocks to
+    bound memory.
+    """
+    replicates = []
+    for block_start in range(0, num_samples, BOOTSTRAP_BLOCK):
+        block_size = min(BOOTSTRAP_BLOCK, num_samples - block_start)
+        weights = rng.poisson(1.0, (block_size, values.shape[1])).astype(float)
+        replicates.append(weights @ values.T / weights.sum(axis=1, keepdims=True))
+    return numpy.concatenate(replicates)
+
+
+def bootstrap_pairs(con, pairs, num_samples, confidence, seed, tie_tol=DEFAULT_TIE_TOL):
+    """
+    Add percentile bootstrap confidence intervals, resampling respondents,
+    for delta_mean and the win rates of every pair. Each dataset is fetched
+    once.
+    """
+    rng = numpy.random.default_rng(seed)
+    alpha = (1 - confidence) / 2
+    ci_cols = ["delta_mean", "model1_win_rate", "model2_win_rate"]
+    intervals = {f"{col}_{end}": numpy.full(len(pairs), numpy.nan) for col in ci_cols for end in ["lo", "hi"]}
+    for dataset, dataset_pairs in pairs.groupby("dataset"):
+        wide = con.execute(
+            "SELECT model, respondent, value FROM fits WHERE dataset = ?",
+            [dataset]
+        ).df().pivot(index="respondent", columns="model", values="value")
+        for idx, row in dataset_pairs.iterrows():
+            value1 = wide[row["model1"]].to_numpy()
+            value2 = wide[row["model2"]].to_numpy()
+            valid = ~(numpy.isnan(value1) | numpy.isnan(value2))
+            if not valid.any():
+                continue
+            delta = value1[valid] - value2[valid]
+            replicates = bootstrap_means(
+                numpy.stack([delta, delta < -tie_tol, delta > tie_tol]).astype(float),
+                num_samples,
+                rng
+            )
+            los, his = numpy.nanquantile(replicates, [alpha, 1 - alpha], axis=0)
+            pos = pairs.index.get_loc(idx)
+            for col, lo, hi in zip(ci_cols, los, his):
+                intervals[f"{col}_lo"][pos] = lo
+                intervals[f"{col}_hi"][pos] = hi
+    return pairs.assign(**intervals)
+
+
+@main.command("all")
+@click.argument("work", type=click.Path(exists=True, file_okay=False))
+@click.option("--measure", default="aic")
+@click.option("--bootstrap", type=int, default=0, help="Number of bootstrap samples for confidence intervals")
+@click.option("--confidence", type=float, default=0.95)
+@click.option("--seed", type=int, default=0)
+@click.option("--tie-tol", type=float, default=DEFAULT_TIE_TOL)
+@click.option("--out", type=click.Path(), help="Write the comparison table to this parquet or .csv file")
+def compare_all(work, measure, bootstrap, confidence, seed, tie_tol, out):
+    """
+    Compare every pair of models fitted to the same dataset under WORK,
+    joining on respondent. delta is model1's measure minus model2's.
+    """
+    from ..dataset import connect
+
+    con = connect()
+    if not register_fits(con, work, measure):
+        print(f"No results with {measure} found under {work}")
+        return
+    pairs = con.execute(PAIRS_SQL, {"tie_tol": tie_tol}).df()
+    if bootstrap:
+        pairs = bootstrap_pairs(con, pairs, bootstrap, confidence, seed, tie_tol)
+    with pandas.option_context(
+        "display.max_rows", None, "display.max_columns", None, "display.width", 250
+    ):
+        print(pairs)
+    if out is not None:
+        if out.endswith(".csv"):
+            pairs.to_csv(out, index=False)
+        else:
+            pairs.to_parquet(out)
+
+
 if __name__ == "__main__":
     main()
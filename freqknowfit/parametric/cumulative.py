@@ -0,0 +1,263 @@
+"""
+Cumulative link (ordered logit/probit/cloglog) regressions of the score on
+zipf, fitted with Newton's method for all respondents at once.
+
+Each respondent's scores are ranked among the levels they actually used,
+and P(rank >= j) = F(a_j + b * zipf) for j = 1, ..., m - 1, where F is the
+inverse of the link and m is their number of distinct levels. The
+thresholds a_j decrease with j and the slope b is shared between them.
+Parameters are padded to the largest possible number of thresholds so that
+every respondent's Newton step is a small dense solve; padding is held at
+zero by an identity Hessian.
+"""
+import numpy
+import pandas
+
+from ..dense import DenseResponses
+from .batched_glm import PERFECT_SEPARATION_TOL, group_extent
+from .links import LINKS, TINY
+
+
+MAXITER = 100
+TOL = 1e-8
+MAX_HALVINGS = 30
+
+
+def category_probs(upper, lower, link):
+    """
+    P(upper threshold passed) - P(lower threshold passed), where a missing
+    threshold (NaN) is always or never passed respectively. Differences are
+    taken between complements in the upper tail.
+    """
+    has_upper = ~numpy.isnan(upper)
+    has_lower = ~numpy.isnan(lower)
+    upper = numpy.where(has_upper, upper, numpy.inf)
+    lower = numpy.where(has_lower, lower, -numpy.inf)
+    # Diverging (separated) fits overflow the cloglog
+    with numpy.errstate(over="ignore", invalid="ignore"):
+        upper_tail = upper + lower > 0
+        return numpy.where(
+            upper_tail,
+            link.inverse_complement(lower) - link.inverse_complement(upper),
+            link.inverse(upper) - link.inverse(lower),
+        )
+
+
+def fit_cumulative(codes, num_groups, x, level, num_levels, link_name, maxiter=MAXITER, tol=TOL):
+    """
+    Fit each group in codes, whose observations are at the given indices of
+    num_levels levels, to thresholds between the levels it used and a
+    slope on x. Returns a dict of per-group arrays.
+    """
+    link = LINKS[link_name]
+    num_params = num_levels
+    slope = num_params - 1
+
+    def group_sum(group_codes, weights):
+        return numpy.bincount(group_codes, weights=weights, minlength=num_groups)
+
+    def group_counts(values):
+        return numpy.bincount(
+            codes * num_levels + values, minlength=num_groups * num_levels
+        ).reshape(num_groups, num_levels)
+
+    counts = group_counts(level)
+    used = counts > 0
+    num_used = used.sum(axis=1)
+    rank = (used.cumsum(axis=1) - 1)[codes, level]
+    rank_counts = group_counts(rank)
+    x_min, x_max = group_extent(codes, num_groups, x)
+    degenerate = x_min == x_max
+    single_level = num_used < 2
+    # Thresholds beyond a group's own levels
+    padding = numpy.arange(num_params - 1) >= (num_used - 1)[:, None]
+    # Threshold columns (with the slope as a dummy) of each observation
+    upper_col = numpy.where(rank > 0, rank - 1, slope)
+    has_upper = rank > 0
+    has_lower = rank < num_used[codes] - 1
+    lower_col = numpy.where(has_lower, rank, slope)
+
+    def evaluate(params, groups):
+        """
+        The log likelihood of groups with its gradient and negated Hessian.
+        Other groups get zeros.
+        """
+        rows = groups[codes]
+        group_codes = codes[rows]
+        x_act = x[rows]
+        p_rows = params[group_codes]
+        u_col = upper_col[rows]
+        l_col = lower_col[rows]
+        u_ok = has_upper[rows]
+        l_ok = has_lower[rows]
+        slope_x = p_rows[:, slope] * x_act
+        upper = numpy.where(u_ok, p_rows[numpy.arange(len(u_col)), u_col] + slope_x, numpy.nan)
+        lower = numpy.where(l_ok, p_rows[numpy.arange(len(l_col)), l_col] + slope_x, numpy.nan)
+        prob = numpy.maximum(category_probs(upper, lower, link), TINY)
+        with numpy.errstate(over="ignore", invalid="ignore"):
+            g_u = numpy.where(u_ok, link.inverse_deriv(upper) / prob, 0)
+            g_l = numpy.where(l_ok, -link.inverse_deriv(lower) / prob, 0)
+            j_uu = numpy.where(u_ok, g_u ** 2 - link.inverse_deriv2(upper) / prob, 0)
+            j_ll = numpy.where(l_ok, g_l ** 2 + link.inverse_deriv2(lower) / prob, 0)
+        j_ul = g_u * g_l
+        log_lik = group_sum(group_codes, numpy.log(prob))
+        slope_col = numpy.full(len(u_col), slope)
+        grad_cols = numpy.concatenate([u_col, l_col, slope_col])
+        grad = numpy.bincount(
+            numpy.tile(group_codes, 3) * num_params + grad_cols,
+            weights=numpy.concatenate([
+                numpy.where(u_ok, g_u, 0),
+                numpy.where(l_ok, g_l, 0),
+                (g_u + g_l) * x_act,
+            ]),
+            minlength=num_groups * num_params,
+        ).reshape(num_groups, num_params)
+        # Both triangles of the symmetric entries of each observation
+        row_cols = [u_col, l_col, u_col, l_col, u_col, slope_col, l_col, slope_col, slope_col]
+        col_cols = [u_col, l_col, l_col, u_col, slope_col, u_col, slope_col, l_col, slope_col]
+        u_slope = (j_uu + j_ul) * x_act
+        l_slope = (j_ll + j_ul) * x_act
+        values = [
+            j_uu, j_ll, j_ul, j_ul, u_slope, u_slope, l_slope, l_slope,
+            (j_uu + 2 * j_ul + j_ll) * x_act ** 2,
+        ]
+        hess = numpy.bincount(
+            (
+                numpy.tile(group_codes, len(values)) * num_params ** 2
+                + numpy.concatenate(row_cols) * num_params
+                + numpy.concatenate(col_cols)
+            ),
+            weights=numpy.concatenate(values),
+            minlength=num_groups * num_params ** 2,
+        ).reshape(num_groups, num_params, num_params)
+        pad_groups, pad_cols = numpy.nonzero(padding)
+        hess[pad_groups, pad_cols, pad_cols] = 1
+        hess[~groups] = 0
+        grad[~groups] = 0
+        log_lik[~groups] = 0
+        return log_lik, grad, hess
+
+    # Start from the marginal proportions with no slope
+    passed = (
+        rank_counts[:, ::-1].cumsum(axis=1)[:, ::-1][:, 1:]
+        / rank_counts.sum(axis=1, keepdims=True)
+    )
+    params = numpy.zeros((num_groups, num_params))
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        params[:, :slope] = numpy.where(padding, 0, link.link(passed))
+    iterations = numpy.zeros(num_groups, dtype=numpy.int64)
+    converged = numpy.zeros(num_groups, dtype=bool)
+    active = ~(single_level | degenerate)
+    log_lik, grad, hess = evaluate(params, active)
+
+    for _ in range(maxiter):
+        groups = numpy.flatnonzero(active)
+        if not len(groups):
+            break
+        step = numpy.zeros_like(params)
+        step[groups] = numpy.linalg.solve(hess[groups], grad[groups, :, None])[..., 0]
+        step_size = numpy.ones(num_groups)
+        new_params = params + step
+        new_log_lik, new_grad, new_hess = evaluate(new_params, active)
+        # Halve the steps of groups which got worse, including those whose
+        # thresholds crossed
+        for _ in range(MAX_HALVINGS):
+            worse = active & ~(new_log_lik >= log_lik - tol)
+            if not worse.any():
+                break
+            step_size[worse] /= 2
+            new_params[worse] = params[worse] + step_size[worse, None] * step[worse]
+            retry_log_lik, retry_grad, retry_hess = evaluate(new_params, worse)
+            new_log_lik[worse] = retry_log_lik[worse]
+            new_grad[worse] = retry_grad[worse]
+            new_hess[worse] = retry_hess[worse]
+        iterations[active] += 1
+        newly_converged = active & (numpy.abs(new_log_lik - log_lik) <= tol)
+        params[active] = new_params[active]
+        log_lik[active] = new_log_lik[active]
+        grad[active] = new_grad[active]
+        hess[active] = new_hess[active]
+        converged |= newly_converged
+        active &= ~newly_converged
+
+    # Separated when every observation's category is all but certain
+    eta = params[codes, slope] * x
+    upper = numpy.where(has_upper, params[codes, upper_col] + eta, numpy.nan)
+    lower = numpy.where(has_lower, params[codes, lower_col] + eta, numpy.nan)
+    prob = category_probs(upper, lower, link)
+    separated = group_sum(codes, prob < 1 - PERFECT_SEPARATION_TOL) == 0
+    return {
+        "params": params,
+        "llf": log_lik,
+        "num_used": num_used,
+        "used": used,
+        "iterations": iterations,
+        "converged": converged,
+        "single_level": single_level,
+        "degenerate": degenerate,
+        "separated": separated & ~(single_level | degenerate),
+    }
+
+
+def cumulative_cols(result, respondents, levels):
+    """
+    The columns of a fit_cumulative(...) result. The intercept of
+    P(score >= level) is given as const_coef_{level} for every level but the
+    lowest, mapped from the respondent's own thresholds: it is +inf if they
+    never scored below level and -inf if they never reached it. const_coef
+    is that of the second lowest level, corresponding to known.
+    """
+    params = result["params"]
+    num_groups = len(params)
+    failure = numpy.where(
+        result["single_level"],
+        "single_level",
+        numpy.where(
+            result["degenerate"],
+            "degenerate_zipf",
+            numpy.where(result["separated"], "perfect_separation", None)
+        )
+    )
+    ok = failure == None  # noqa: E711
+    # The threshold index of each level: number of used levels below it
+    below = result["used"].cumsum(axis=1)[:, :-1]
+    cols = {}
+    for idx, level in enumerate(levels[1:]):
+        threshold = below[:, idx]
+        coef = params[numpy.arange(num_groups), numpy.maximum(threshold - 1, 0)]
+        coef = numpy.where(threshold == 0, numpy.inf, coef)
+        coef = numpy.where(threshold == result["num_used"], -numpy.inf, coef)
+        cols[f"const_coef_{level}"] = coef
+    cols = {
+        "const_coef": cols[f"const_coef_{levels[1]}"],
+        "zipf_coef": params[:, -1],
+        **cols,
+        "aic": 2 * result["num_used"] - 2 * result["llf"],
+    }
+    cols = {k: numpy.where(ok, v, numpy.nan) for k, v in cols.items()}
+    cols["respondent"] = respondents.to_numpy()
+    cols["iterations"] = result["iterations"]
+    cols["converged"] = result["converged"] & ok
+    cols["failure"] = failure
+    return cols
+
+
+def fit_batched_cumulative(df, link, levels, start=None):
+    """
+    Fit every respondent of df, a DataFrame or DenseResponses with a score,
+    whose scores are among levels. Returns a dict of columns. start is
+    accepted for warm starts but not used.
+    """
+    levels = numpy.asarray(levels)
+    if isinstance(df, DenseResponses):
+        respondents = pandas.Index(df.respondents)
+        codes = numpy.repeat(numpy.arange(len(df)), df.num_items)
+        x = numpy.tile(numpy.asarray(df.zipf, dtype=float), len(df))
+        score = numpy.asarray(df.score).ravel()
+    else:
+        codes, respondents = pandas.factorize(df["respondent"], sort=True)
+        x = df["zipf"].to_numpy(dtype=float)
+        score = df["score"].to_numpy()
+    level = numpy.searchsorted(levels, score)
+    result = fit_cumulative(codes, len(respondents), x, level, len(levels), link)
+    return cumulative_cols(result, respondents, levels)
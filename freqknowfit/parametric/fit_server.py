@@ -0,0 +1,209 @@
+"""
+A long-lived local process which runs regress fits with the libraries
+already imported and the Stan models already loaded, so that each fit job
+of a workflow doesn't pay for them again:
+
+    $ python -m freqknowfit.parametric.fit_server serve /tmp/freqknowfit.sock &
+    $ python -m freqknowfit.parametric.regress ... --server /tmp/freqknowfit.sock
+
+regress falls back to fitting in-process when nothing is listening on the
+socket. Each connection carries one request: a JSON line with the
+arguments of regress.fit_dataset(...). The server streams back what the fit
+prints, one JSON line per printed line, and then a final line saying
+whether it succeeded. Requests are handled one at a time, each with the
+server's own environment; fits with --workers still fork worker processes,
+which inherit the loaded libraries.
+"""
+import contextlib
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import traceback
+
+import click
+
+
+def send_message(outf, message):
+    outf.write((json.dumps(message) + "\n").encode("utf-8"))
+    outf.flush()
+
+
+class LineSender:
+    """
+    A text stream which sends each complete line written to it as an output
+    message.
+    """
+    def __init__(self, outf):
+        self.outf = outf
+        self.buf = ""
+
+    def write(self, text):
+        self.buf += text
+        *lines, self.buf = self.buf.split("\n")
+        for line in lines:
+            send_message(self.outf, {"output": line})
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+@contextlib.contextmanager
+def restore_environ():
+    # regress sets defaults such as TORCH_THREADS for the request at hand
+    saved = dict(os.environ)
+    try:
+        yield
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+
+
+class FitHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        from .regress import fit_dataset
+
+        line = self.rfile.readline()
+        if not line:
+            # Just checking the server is up
+            return
+        request = json.loads(line)
+        print(f"Fitting {','.join(request['methods'])} to {request['dfin']}")
+        sender = LineSender(self.wfile)
+        try:
+            with restore_environ(), contextlib.redirect_stdout(sender):
+                fit_dataset(**request)
+        except BrokenPipeError:
+            print("Client disconnected; fit abandoned", file=sys.stderr)
+            return
+        except Exception:
+            traceback.print_exc()
+            send_message(self.wfile, {"error": traceback.format_exc()})
+            return
+        send_message(self.wfile, {"done": True})
+
+
+def warm_up(stan=True):
+    """
+    Import the fitting libraries and load every Stan model used by regress.
+    """
+    import pandas  # noqa: F401
+    import statsmodels.api  # noqa: F401
+    from . import batched_glm, cumulative, glmm, inflated, warm_start  # noqa: F401
+    from .regress import STAN_MODELS, STAN_SLIM_MODELS
+
+    try:
+        from . import pytorch_oneinf  # noqa: F401
+    except ImportError:
+        print("PyTorch is not installed; skipping it")
+    if not stan:
+        return
+    from .stan_cache import get_stan_model
+
+    models = {
+        **STAN_MODELS,
+        **{link + "Slim": code for link, code in STAN_SLIM_MODELS.items()},
+    }
+    for name, code in models.items():
+        try:
+            get_stan_model(name, code)
+        except Exception as exc:
+            # CmdStan may be missing when only the other methods are used
+            print(f"Could not load Stan model {name}: {exc}")
+            return
+
+
+def connect(socket_path):
+    """
+    A socket connected to the server at socket_path, or None if no server is
+    listening there.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+    return sock
+
+
+def request_fit(socket_path, methods, dfin, dfouts, workers=1, resume=False, warm_start=False):
+    """
+    Run regress.fit_dataset(...) on the server at socket_path, printing its
+    output as it arrives. Returns False, having done nothing, if no server is
+    listening there.
+    """
+    sock = connect(socket_path)
+    if sock is None:
+        return False
+    request = {
+        "methods": list(methods),
+        # The server has its own working directory
+        "dfin": os.path.abspath(dfin),
+        "dfouts": [os.path.abspath(dfout) for dfout in dfouts],
+        "workers": workers,
+        "resume": resume,
+        "warm_start": warm_start,
+    }
+    with sock, sock.makefile("rwb") as sockf:
+        send_message(sockf, request)
+        for line in sockf:
+            message = json.loads(line)
+            if "output" in message:
+                print(message["output"], flush=True)
+            elif "error" in message:
+                raise RuntimeError(f"Fitting on the server failed:\n{message['error']}")
+            elif message.get("done"):
+                return True
+    raise RuntimeError("The fit server closed the connection before finishing")
+
+
+@click.group()
+def main():
+    pass
+
+
+@main.command()
+@click.argument("socket_path", type=click.Path())
+@click.option("--stan/--no-stan", default=True, help="Load the Stan models up front")
+def serve(socket_path, stan):
+    """
+    Serve fits on the Unix socket SOCKET_PATH until interrupted.
+    """
+    if os.path.exists(socket_path):
+        sock = connect(socket_path)
+        if sock is not None:
+            sock.close()
+            raise click.UsageError(f"A server is already listening on {socket_path}")
+        # Left behind by a server which was killed
+        os.unlink(socket_path)
+    warm_up(stan)
+    # Exit through the finally below so the socket file is removed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    with socketserver.UnixStreamServer(socket_path, FitHandler) as server:
+        print(f"Listening on {socket_path}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(socket_path)
+
+
+@main.command()
+@click.argument("socket_path", type=click.Path())
+def ping(socket_path):
+    """
+    Exit with status 0 if a server is listening on SOCKET_PATH and 1 otherwise.
+    """
+    sock = connect(socket_path)
+    if sock is None:
+        sys.exit(1)
+    sock.close()
+
+
+if __name__ == "__main__":
+    main()
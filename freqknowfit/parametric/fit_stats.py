@@ -0,0 +1,96 @@
+"""
+Summarise the per-respondent fitting statistics written by regress.py
+across every results directory under a work directory (e.g. the Snakemake
+WORK directory).
+"""
+from glob import glob
+from os.path import dirname, join as pjoin, relpath
+
+import click
+import pandas
+
+from .regress import STATS_COLUMNS
+from .results import STATS_DIR, list_stats_parts, path_params, read_fit_method
+
+
+def read_run_stats(fit_dir, work):
+    df = pandas.concat(
+        [pandas.read_parquet(path) for path in list_stats_parts(fit_dir)],
+        ignore_index=True
+    )
+    # Older runs have fewer statistics
+    for col in STATS_COLUMNS:
+        if col not in df:
+            df[col] = None
+    params = path_params(relpath(fit_dir, work))
+    df["method"] = read_fit_method(fit_dir) or params.get("model")
+    df["dataset"] = params.get("dataset", relpath(fit_dir, work))
+    return df
+
+
+def read_all_stats(work):
+    fit_dirs = sorted(
+        dirname(stats_dir)
+        for stats_dir in glob(pjoin(work, "**", STATS_DIR), recursive=True)
+    )
+    runs = [
+        read_run_stats(fit_dir, work)
+        for fit_dir in fit_dirs
+        if list_stats_parts(fit_dir)
+    ]
+    if not runs:
+        return None
+    return pandas.concat(runs, ignore_index=True)
+
+
+def summarise(df):
+    grouped = df.groupby(["method", "dataset"])
+    return pandas.DataFrame({
+        "respondents": grouped.size(),
+        "total_seconds": grouped["seconds"].sum(),
+        "mean_seconds": grouped["seconds"].mean(),
+        "max_seconds": grouped["seconds"].max(),
+        "mean_iterations": grouped["iterations"].mean(),
+        "failure_rate": grouped["failure"].apply(lambda col: col.notna().mean()),
+        "unconverged_rate": grouped["converged"].apply(lambda col: (col == False).mean()),  # noqa: E712
+        "warm_start_rate": grouped["start"].apply(lambda col: col.notna().mean()),
+    }).sort_values("total_seconds", ascending=False)
+
+
+@click.command()
+@click.argument("work", type=click.Path(exists=True, file_okay=False))
+@click.option("--slowest", type=int, default=20, help="Number of slowest respondents to list")
+@click.option("--out", type=click.Path(), help="Write the method x dataset summary to this parquet file")
+def main(work, slowest, out):
+    df = read_all_stats(work)
+    if df is None:
+        print(f"No fitting statistics found under {work}")
+        return
+    summary = summarise(df)
+    with pandas.option_context(
+        "display.max_rows", None, "display.max_columns", None, "display.width", 200
+    ):
+        print("Time and failures by method x dataset:")
+        print(summary)
+        print()
+        print("Failure reasons:")
+        print(
+            df[df["failure"].notna()]
+            .groupby(["method", "dataset", "failure"])
+            .size()
+            .rename("count")
+            .to_frame()
+        )
+        print()
+        print(f"Slowest {slowest} respondents:")
+        print(
+            df.nlargest(slowest, "seconds")[
+                ["method", "dataset", "respondent", "seconds", "iterations", "converged", "failure"]
+            ].to_string(index=False)
+        )
+    if out is not None:
+        summary.reset_index().to_parquet(out)
+
+
+if __name__ == "__main__":
+    main()
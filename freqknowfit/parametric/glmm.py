@@ -0,0 +1,334 @@
+"""
+Binary regressions with a random intercept and slope on zipf for each
+respondent, fitted with the Laplace approximation for all respondents at
+once.
+
+Each respondent's coefficients (const_coef, zipf_coef) are drawn from a
+bivariate normal population N(mean, cov). Given the population,
+respondents are independent. Their conditional modes are found together by
+Newton iterations on per-respondent sums, like batched_glm. The Hessian at
+each mode gives the Laplace approximation to that respondent's marginal
+likelihood.
+
+The population is estimated by maximising the total Laplace approximation
+with EM-like fixed point iterations. Each pass over the data finds the
+modes under the current population, warm started from the previous pass.
+mean and cov are then set to the mean and second moment of the approximate
+posteriors: normals at the modes, with their means shifted to first order
+by the skew of the likelihood. Without the shift, the estimates are pulled
+towards zero since binary likelihoods are skewed. With it, the fixed point
+is where the gradient of the total Laplace approximation is zero. Only each
+respondent's mode is kept between passes, so memory grows linearly with
+respondents plus one chunk of data.
+"""
+from dataclasses import dataclass
+
+import numpy
+import pandas
+from scipy import special
+
+from ..dense import DenseResponses
+
+
+NUM_POPULATION_PARAMS = 5
+INITIAL_COV = numpy.diag([10.0, 1.0])
+POPULATION_MAXITER = 500
+# Per respondent change in the total log marginal likelihood
+POPULATION_TOL = 1e-6
+NEWTON_MAXITER = 100
+NEWTON_TOL = 1e-8
+MAX_HALVINGS = 30
+MAX_EXP_ETA = 700.0
+LOG_2PI = numpy.log(2 * numpy.pi)
+
+
+def log_cdf_derivs(eta, link):
+    """
+    log F(eta), where F is the inverse of link, and its first three
+    derivatives.
+    """
+    if link == "logit":
+        p_neg = special.expit(-eta)
+        d2 = -p_neg * special.expit(eta)
+        return -numpy.logaddexp(0, -eta), p_neg, d2, d2 * (2 * p_neg - 1)
+    elif link == "probit":
+        log_cdf = special.log_ndtr(eta)
+        d1 = numpy.exp(-0.5 * eta ** 2 - 0.5 * LOG_2PI - log_cdf)
+        d2 = -d1 * (eta + d1)
+        return log_cdf, d1, d2, -d2 * (eta + d1) - d1 * (1 + d2)
+    elif link == "cloglog":
+        s = numpy.exp(numpy.minimum(eta, MAX_EXP_ETA))
+        cdf = -numpy.expm1(-s)
+        with numpy.errstate(over="ignore"):
+            d1 = s / numpy.expm1(s)
+        ratio = s / cdf
+        d2 = d1 * (1 - ratio)
+        return numpy.log(cdf), d1, d2, d2 * (1 - ratio) - d1 * ratio * (1 - d1)
+    else:
+        raise ValueError(f"Unknown link: {link}")
+
+
+def log_lik_derivs(eta, y, link):
+    """
+    Log likelihoods of the binary responses y given linear predictors eta,
+    and their first, negated second and negated third derivatives in eta.
+    These are computed on the log scale so that badly mispredicted responses
+    keep their gradient.
+    """
+    if link == "cloglog":
+        log_cdf, d1, d2, d3 = log_cdf_derivs(eta, link)
+        s = numpy.exp(numpy.minimum(eta, MAX_EXP_ETA))
+        return (
+            numpy.where(y, log_cdf, -s),
+            numpy.where(y, d1, -s),
+            numpy.where(y, -d2, s),
+            numpy.where(y, -d3, s),
+        )
+    # 1 - F(eta) = F(-eta) for the symmetric links
+    sign = numpy.where(y, 1.0, -1.0)
+    log_cdf, d1, d2, d3 = log_cdf_derivs(sign * eta, link)
+    return log_cdf, sign * d1, -d2, -sign * d3
+
+
+@dataclass
+class LaplaceResult:
+    params: numpy.ndarray
+    hess: numpy.ndarray
+    mean_shift: numpy.ndarray
+    log_lik: numpy.ndarray
+    log_marginal: numpy.ndarray
+    iterations: numpy.ndarray
+    converged: numpy.ndarray
+
+
+def laplace_modes(codes, num_groups, x, y, link, mean, cov, start=None, maxiter=NEWTON_MAXITER, tol=NEWTON_TOL):
+    """
+    The conditional modes of the coefficients of each group in codes under
+    the N(mean, cov) population, with the Laplace approximation to each
+    group's log marginal likelihood. Groups start from the (num_groups, 2)
+    coefficients start where they are finite and otherwise from mean.
+
+    Also gives each group's mean_shift, the first order correction from the
+    mode to the posterior mean due to the skew of the likelihood.
+    """
+    mean = numpy.asarray(mean, dtype=float)
+    cov = numpy.asarray(cov, dtype=float)
+    precision = numpy.linalg.inv(cov)
+
+    def group_sum(group_codes, weights):
+        return numpy.bincount(group_codes, weights=weights, minlength=num_groups)
+
+    def evaluate(params, groups):
+        """
+        The penalised log likelihood of groups, with its gradient and
+        negated Hessian. Other groups get zeros.
+        """
+        rows = groups[codes]
+        group_codes = codes[rows]
+        x_act = x[rows]
+        eta = params[group_codes, 0] + params[group_codes, 1] * x_act
+        ll, g, h, _ = log_lik_derivs(eta, y[rows], link)
+        diff = params - mean
+        penalty = 0.5 * numpy.einsum("gi,ij,gj->g", diff, precision, diff)
+        log_lik = group_sum(group_codes, ll)
+        grad = numpy.stack([
+            group_sum(group_codes, g),
+            group_sum(group_codes, g * x_act),
+        ], axis=1) - diff @ precision
+        shx = group_sum(group_codes, h * x_act)
+        hess = numpy.stack([
+            numpy.stack([group_sum(group_codes, h), shx], axis=1),
+            numpy.stack([shx, group_sum(group_codes, h * x_act ** 2)], axis=1),
+        ], axis=1) + precision
+        return log_lik, log_lik - penalty, grad, hess
+
+    params = numpy.tile(mean, (num_groups, 1))
+    if start is not None:
+        start = numpy.asarray(start, dtype=float)[:, :2]
+        warm = numpy.isfinite(start).all(axis=1)
+        params[warm] = start[warm]
+    iterations = numpy.zeros(num_groups, dtype=numpy.int64)
+    converged = numpy.zeros(num_groups, dtype=bool)
+    active = numpy.ones(num_groups, dtype=bool)
+    _, objective, grad, hess = evaluate(params, active)
+
+    for _ in range(maxiter):
+        groups = numpy.flatnonzero(active)
+        if not len(groups):
+            break
+        step = numpy.zeros_like(params)
+        step[groups] = numpy.linalg.solve(hess[groups], grad[groups, :, None])[..., 0]
+        step_size = numpy.ones(num_groups)
+        new_params = params + step
+        _, new_objective, new_grad, new_hess = evaluate(new_params, active)
+        # Halve the steps of groups which got worse
+        for _ in range(MAX_HALVINGS):
+            worse = active & ~(new_objective >= objective - tol)
+            if not worse.any():
+                break
+            step_size[worse] /= 2
+            new_params[worse] = params[worse] + step_size[worse, None] * step[worse]
+            _, retry_objective, retry_grad, retry_hess = evaluate(new_params, worse)
+            new_objective[worse] = retry_objective[worse]
+            new_grad[worse] = retry_grad[worse]
+            new_hess[worse] = retry_hess[worse]
+        iterations[active] += 1
+        newly_converged = active & (numpy.abs(new_objective - objective) <= tol)
+        params[active] = new_params[active]
+        objective[active] = new_objective[active]
+        grad[active] = new_grad[active]
+        hess[active] = new_hess[active]
+        converged |= newly_converged
+        active &= ~newly_converged
+
+    log_lik, objective, _, hess = evaluate(params, numpy.ones(num_groups, dtype=bool))
+    hess_inv = numpy.linalg.inv(hess)
+    eta = params[codes, 0] + params[codes, 1] * x
+    dh = log_lik_derivs(eta, y, link)[3]
+    # x^T hess^-1 x for each row
+    spread = (
+        hess_inv[codes, 0, 0]
+        + 2 * hess_inv[codes, 0, 1] * x
+        + hess_inv[codes, 1, 1] * x ** 2
+    )
+    skew = -0.5 * numpy.stack([
+        group_sum(codes, dh * spread),
+        group_sum(codes, dh * spread * x),
+    ], axis=1)
+    # The normal constants cancel with the 2 pi of the Laplace integral
+    log_marginal = (
+        objective
+        - 0.5 * numpy.linalg.slogdet(cov)[1]
+        - 0.5 * numpy.linalg.slogdet(hess)[1]
+    )
+    return LaplaceResult(
+        params=params,
+        hess=hess,
+        mean_shift=(hess_inv @ skew[..., None])[..., 0],
+        log_lik=log_lik,
+        log_marginal=log_marginal,
+        iterations=iterations,
+        converged=converged,
+    )
+
+
+def chunk_arrays(chunk):
+    """
+    Codes, respondents, zipfs and knowns of a DataFrame or DenseResponses.
+    """
+    if isinstance(chunk, DenseResponses):
+        return (
+            numpy.repeat(numpy.arange(len(chunk)), chunk.num_items),
+            chunk.respondents,
+            numpy.tile(chunk.zipf, len(chunk)),
+            chunk.known.ravel(),
+        )
+    codes, respondents = pandas.factorize(chunk["respondent"], sort=True)
+    return (
+        codes,
+        respondents,
+        chunk["zipf"].to_numpy(dtype=float),
+        chunk["known"].to_numpy(dtype=bool),
+    )
+
+
+def chunk_modes(chunk, link, mean, cov, start=None):
+    codes, respondents, x, y = chunk_arrays(chunk)
+    return respondents, laplace_modes(
+        codes, len(respondents), x, y, link, mean, cov, start=start
+    )
+
+
+def fit_population(iter_chunks, link, maxiter=POPULATION_MAXITER, tol=POPULATION_TOL):
+    """
+    Estimate the population mean and cov by EM over every respondent in the
+    chunks of whole respondents given by iter_chunks(), which is called once
+    per pass. Returns a dict including the total Laplace log marginal
+    likelihood at the returned mean and cov.
+    """
+    mean = numpy.zeros(2)
+    cov = INITIAL_COV
+    modes = []
+    previous = -numpy.inf
+    converged = False
+    for iteration in range(1, maxiter + 1):
+        total = 0.0
+        num_respondents = 0
+        sum_params = numpy.zeros(2)
+        sum_shift = numpy.zeros(2)
+        sum_outer = numpy.zeros((2, 2))
+        sum_shift_outer = numpy.zeros((2, 2))
+        for idx, chunk in enumerate(iter_chunks()):
+            _, result = chunk_modes(
+                chunk, link, mean, cov, modes[idx] if idx < len(modes) else None
+            )
+            if idx < len(modes):
+                modes[idx] = result.params
+            else:
+                modes.append(result.params)
+            ok = numpy.isfinite(result.log_marginal)
+            params = result.params[ok]
+            shift = result.mean_shift[ok]
+            total += result.log_marginal[ok].sum()
+            num_respondents += ok.sum()
+            sum_params += params.sum(axis=0)
+            sum_shift += shift.sum(axis=0)
+            sum_outer += (
+                params.T @ params + numpy.linalg.inv(result.hess[ok]).sum(axis=0)
+            )
+            sum_shift_outer += shift.T @ params
+        converged = abs(total - previous) <= tol * num_respondents
+        if converged:
+            break
+        previous = total
+        mean = (sum_params + sum_shift) / num_respondents
+        # The mean of outer(params - mean) + hess^-1 plus the shift terms,
+        # from the sums
+        cross = sum_shift_outer - numpy.outer(sum_shift, mean)
+        cov = (
+            sum_outer
+            - numpy.outer(mean, sum_params)
+            - numpy.outer(sum_params, mean)
+            + cross
+            + cross.T
+        ) / num_respondents + numpy.outer(mean, mean)
+    return {
+        "mean": mean,
+        "cov": cov,
+        "num_respondents": num_respondents,
+        "log_marginal": total,
+        "iterations": iteration,
+        "converged": converged,
+    }
+
+
+def fit_batched_glmm(df, link, population, start=None):
+    """
+    Each respondent's conditional modes given the population estimated by
+    fit_population(...), as a dict of columns. df may be a DataFrame or
+    DenseResponses. Each respondent's aic is their share of the AIC of the
+    whole model, with the NUM_POPULATION_PARAMS population parameters split
+    evenly between the respondents of the dataset.
+    """
+    respondents, result = chunk_modes(
+        df, link, population["mean"], population["cov"], start
+    )
+    ok = numpy.isfinite(result.log_marginal) & numpy.isfinite(result.params).all(axis=1)
+    with numpy.errstate(invalid="ignore"):
+        bse = numpy.sqrt(numpy.diagonal(numpy.linalg.inv(result.hess), axis1=1, axis2=2))
+    cols = {
+        "const_coef": result.params[:, 0],
+        "zipf_coef": result.params[:, 1],
+        "const_err": bse[:, 0],
+        "zipf_err": bse[:, 1],
+        "aic": (
+            -2 * result.log_marginal
+            + 2 * NUM_POPULATION_PARAMS / population["num_respondents"]
+        ),
+    }
+    cols = {k: numpy.where(ok, v, numpy.nan) for k, v in cols.items()}
+    cols["respondent"] = respondents.to_numpy()
+    cols["iterations"] = result.iterations
+    cols["converged"] = result.converged & ok
+    cols["failure"] = numpy.where(ok, None, "glmm_error")
+    return cols
@@ -0,0 +1,271 @@
+"""
+In-process maximum likelihood for one-inflated and zero-inflated binary
+regression, fitted for all respondents at once.
+
+The parameters are (const_coef, zipf_coef, phi_coef) with the inflation
+probability inv_logit(phi_coef), as assumed by sample_reg_curve(...) in
+nonparametric.transfer. Each respondent is fitted by Levenberg-Marquardt
+damped Newton steps using analytic gradients and Hessians accumulated from
+per-observation terms.
+"""
+import numpy
+import pandas
+from scipy import special
+
+from .batched_glm import (
+    PERFECT_SEPARATION_TOL,
+    failure_reasons,
+    group_extent,
+    irls,
+)
+from .links import LINKS, clean
+
+
+NUM_PARAMS = 3
+# Upper triangle of the 3x3 Hessian
+HESS_IDX = [(0, 0), (0, 1), (0, 2), (1, 1), (1, 2), (2, 2)]
+DEFAULT_PHI_START = -3.0
+
+
+def obs_terms(eta, gamma, y, link, one_inflated):
+    """
+    Per-observation log likelihood and its first and second derivatives
+    with respect to the linear predictor eta and the inflation logit gamma.
+
+    Writing c = 1 - p for one-inflation and c = p for zero-inflation (where
+    p is the uninflated probability of knowing), the observations which
+    agree with the inflated outcome have likelihood m = 1 - (1 - pi) c and
+    the rest have likelihood (1 - pi) c.
+    """
+    pi = special.expit(gamma)
+    s = 1 - pi
+    sign = -1 if one_inflated else 1
+    if one_inflated:
+        c = clean(link.inverse_complement(eta))
+    else:
+        c = clean(link.inverse(eta))
+    dc = sign * link.inverse_deriv(eta)
+    d2c = sign * link.inverse_deriv2(eta)
+    mixture = y == (1 if one_inflated else 0)
+
+    m = clean(1 - s * c)
+    dm_eta = -s * dc
+    dm_gamma = pi * s * c
+    d2m_eta = -s * d2c
+    d2m_gamma = pi * s * (1 - 2 * pi) * c
+    d2m_eta_gamma = pi * s * dc
+
+    ll = numpy.where(mixture, numpy.log(m), numpy.log(s) + numpy.log(c))
+    g_eta = numpy.where(mixture, dm_eta / m, dc / c)
+    g_gamma = numpy.where(mixture, dm_gamma / m, -pi)
+    h_eta = numpy.where(
+        mixture,
+        d2m_eta / m - (dm_eta / m) ** 2,
+        d2c / c - (dc / c) ** 2
+    )
+    h_gamma = numpy.where(
+        mixture,
+        d2m_gamma / m - (dm_gamma / m) ** 2,
+        -pi * s
+    )
+    h_eta_gamma = numpy.where(
+        mixture,
+        d2m_eta_gamma / m - dm_eta * dm_gamma / m ** 2,
+        0
+    )
+    return ll, (g_eta, g_gamma), (h_eta, h_gamma, h_eta_gamma)
+
+
+def predicted_prob(eta, gamma, link, one_inflated):
+    pi = special.expit(gamma)
+    p = link.inverse(eta)
+    if one_inflated:
+        return pi + (1 - pi) * p
+    else:
+        return (1 - pi) * p
+
+
+def evaluate(codes, num_groups, x, y, params, link, one_inflated, prior_scale):
+    """
+    Log likelihood, penalised objective, gradient and Hessian per group.
+    """
+    def group_sum(weights):
+        return numpy.bincount(codes, weights=weights, minlength=num_groups)
+
+    eta = params[codes, 0] + params[codes, 1] * x
+    gamma = params[codes, 2]
+    with numpy.errstate(over="ignore", divide="ignore", invalid="ignore"):
+        ll_obs, (g_eta, g_gamma), (h_eta, h_gamma, h_eta_gamma) = obs_terms(
+            eta, gamma, y, link, one_inflated
+        )
+    ll = group_sum(ll_obs)
+    grad = numpy.stack([
+        group_sum(g_eta),
+        group_sum(g_eta * x),
+        group_sum(g_gamma),
+    ], axis=1)
+    hess_upper = [
+        group_sum(h_eta),
+        group_sum(h_eta * x),
+        group_sum(h_eta_gamma),
+        group_sum(h_eta * x ** 2),
+        group_sum(h_eta_gamma * x),
+        group_sum(h_gamma),
+    ]
+    hess = numpy.empty((num_groups, NUM_PARAMS, NUM_PARAMS))
+    for (i, j), entry in zip(HESS_IDX, hess_upper):
+        hess[:, i, j] = entry
+        hess[:, j, i] = entry
+    objective = ll
+    if prior_scale is not None:
+        precision = 1 / prior_scale ** 2
+        objective = ll - 0.5 * precision * (params ** 2).sum(axis=1)
+        grad = grad - precision * params
+        hess = hess - precision * numpy.eye(NUM_PARAMS)
+    return ll, objective, grad, hess
+
+
+def start_params(codes, num_groups, x, y, link):
+    result = irls(codes, num_groups, x, y, link)
+    start = numpy.zeros((num_groups, NUM_PARAMS))
+    start[:, :2] = numpy.where(result.ok[:, None], result.params, 0)
+    start[:, 2] = DEFAULT_PHI_START
+    return start
+
+
+def fit_inflated(
+    codes,
+    num_groups,
+    x,
+    y,
+    link,
+    one_inflated=True,
+    start=None,
+    prior_scale=None,
+    maxiter=200,
+    tol=1e-8,
+):
+    """
+    Maximise the (optionally normal(0, prior_scale) penalised) inflated
+    Bernoulli likelihood for every group in codes. Returns a dict of
+    per-group arrays.
+    """
+    link = LINKS[link] if isinstance(link, str) else link
+    if start is None:
+        start = start_params(codes, num_groups, x, y, link)
+    params = numpy.array(start, dtype=float)
+    cold = ~numpy.isfinite(params).all(axis=1)
+    if cold.any():
+        params[cold] = start_params(codes, num_groups, x, y, link)[cold]
+    x_min, x_max = group_extent(codes, num_groups, x)
+    degenerate = ~(x_max > x_min)
+    iterations = numpy.zeros(num_groups, dtype=numpy.int64)
+    converged = numpy.zeros(num_groups, dtype=bool)
+    damping = numpy.full(num_groups, 1e-3)
+    eye = numpy.eye(NUM_PARAMS)
+
+    ll, objective, grad, hess = evaluate(
+        codes, num_groups, x, y, params, link, one_inflated, prior_scale
+    )
+    active = ~degenerate
+    for _ in range(maxiter):
+        if not active.any():
+            break
+        act_idx = numpy.flatnonzero(active)
+        neg_hess = -hess[act_idx]
+        scale = numpy.maximum(numpy.abs(numpy.diagonal(neg_hess, axis1=1, axis2=2)), 1e-8)
+        damped = neg_hess + damping[act_idx, None, None] * scale[:, :, None] * eye
+        with numpy.errstate(invalid="ignore"):
+            try:
+                step = numpy.linalg.solve(damped, grad[act_idx][:, :, None])[:, :, 0]
+            except numpy.linalg.LinAlgError:
+                step = numpy.stack([
+                    numpy.linalg.lstsq(mat, vec, rcond=None)[0]
+                    for mat, vec in zip(damped, grad[act_idx])
+                ])
+        candidate = params.copy()
+        candidate[act_idx] += step
+        rows = active[codes]
+        cand_ll, cand_objective, cand_grad, cand_hess = evaluate(
+            codes[rows], num_groups, x[rows], y[rows], candidate, link,
+            one_inflated, prior_scale
+        )
+        improvement = cand_objective - objective
+        accept = active & numpy.isfinite(cand_objective) & (improvement >= -tol)
+        params[accept] = candidate[accept]
+        ll[accept] = cand_ll[accept]
+        objective[accept] = cand_objective[accept]
+        grad[accept] = cand_grad[accept]
+        hess[accept] = cand_hess[accept]
+        iterations[active] += 1
+        damping[accept] = numpy.maximum(damping[accept] / 10, 1e-12)
+        damping[active & ~accept] *= 10
+        newly_converged = accept & (numpy.abs(improvement) <= tol)
+        converged |= newly_converged
+        stalled = active & (damping > 1e12)
+        active &= ~(newly_converged | stalled)
+
+    eta = params[codes, 0] + params[codes, 1] * x
+    with numpy.errstate(over="ignore"):
+        prob = predicted_prob(eta, params[codes, 2], link, one_inflated)
+    misfits = numpy.bincount(
+        codes,
+        weights=numpy.abs(prob - y) > PERFECT_SEPARATION_TOL,
+        minlength=num_groups
+    )
+    separated = ~degenerate & (misfits == 0)
+    with numpy.errstate(invalid="ignore"):
+        cov = numpy.full((num_groups, NUM_PARAMS, NUM_PARAMS), numpy.nan)
+        neg_hess = -hess
+        invertible = numpy.isfinite(neg_hess).all(axis=(1, 2))
+        invertible &= numpy.abs(numpy.linalg.det(numpy.where(
+            invertible[:, None, None], neg_hess, eye
+        ))) > 0
+        cov[invertible] = numpy.linalg.inv(neg_hess[invertible])
+        diag = numpy.diagonal(cov, axis1=1, axis2=2)
+        bse = numpy.where(diag > 0, numpy.sqrt(numpy.abs(diag)), numpy.nan)
+    return {
+        "params": params,
+        "bse": bse,
+        "llf": ll,
+        "iterations": iterations,
+        "converged": converged,
+        "separated": separated,
+        "degenerate": degenerate,
+    }
+
+
+def inflated_cols(result):
+    ok = ~(result["separated"] | result["degenerate"])
+    params = result["params"]
+    bse = result["bse"]
+    cols = {
+        "const_coef": params[:, 0],
+        "zipf_coef": params[:, 1],
+        "phi_coef": params[:, 2],
+        "aic": 2 * NUM_PARAMS - 2 * result["llf"],
+        "const_err": bse[:, 0],
+        "zipf_err": bse[:, 1],
+        "phi_err": bse[:, 2],
+    }
+    return {k: numpy.where(ok, v, numpy.nan) for k, v in cols.items()}
+
+
+def fit_batched_inflated(df, link, one_inflated=True, prior_scale=None, start=None):
+    codes, respondents = pandas.factorize(df["respondent"], sort=True)
+    result = fit_inflated(
+        codes,
+        len(respondents),
+        df["zipf"].to_numpy(dtype=float),
+        df["known"].to_numpy(dtype=float),
+        link,
+        one_inflated=one_inflated,
+        start=start,
+        prior_scale=prior_scale,
+    )
+    cols = inflated_cols(result)
+    cols["respondent"] = respondents.to_numpy()
+    cols["iterations"] = result["iterations"]
+    cols["converged"] = result["converged"]
+    cols["failure"] = failure_reasons(result["separated"], result["degenerate"])
+    return cols
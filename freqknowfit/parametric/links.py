@@ -0,0 +1,85 @@
+import numpy
+from scipy import special
+
+
+FLOAT_EPS = numpy.finfo(float).eps
+TINY = numpy.finfo(float).tiny
+
+
+def clean(p):
+    return numpy.clip(p, FLOAT_EPS, 1 - FLOAT_EPS)
+
+
+class Logit:
+    @staticmethod
+    def link(mu):
+        return special.logit(mu)
+
+    @staticmethod
+    def inverse(eta):
+        return special.expit(eta)
+
+    @staticmethod
+    def inverse_complement(eta):
+        return special.expit(-eta)
+
+    @staticmethod
+    def inverse_deriv(eta):
+        mu = special.expit(eta)
+        return mu * (1 - mu)
+
+    @staticmethod
+    def inverse_deriv2(eta):
+        mu = special.expit(eta)
+        return mu * (1 - mu) * (1 - 2 * mu)
+
+
+class Probit:
+    @staticmethod
+    def link(mu):
+        return special.ndtri(mu)
+
+    @staticmethod
+    def inverse(eta):
+        return special.ndtr(eta)
+
+    @staticmethod
+    def inverse_complement(eta):
+        return special.ndtr(-eta)
+
+    @staticmethod
+    def inverse_deriv(eta):
+        return numpy.exp(-0.5 * eta ** 2) / numpy.sqrt(2 * numpy.pi)
+
+    @staticmethod
+    def inverse_deriv2(eta):
+        return -eta * Probit.inverse_deriv(eta)
+
+
+class Cloglog:
+    @staticmethod
+    def link(mu):
+        return numpy.log(-numpy.log1p(-mu))
+
+    @staticmethod
+    def inverse(eta):
+        return -numpy.expm1(-numpy.exp(eta))
+
+    @staticmethod
+    def inverse_complement(eta):
+        return numpy.exp(-numpy.exp(eta))
+
+    @staticmethod
+    def inverse_deriv(eta):
+        return numpy.exp(eta - numpy.exp(eta))
+
+    @staticmethod
+    def inverse_deriv2(eta):
+        return numpy.exp(eta - numpy.exp(eta)) * -numpy.expm1(eta)
+
+
+LINKS = {
+    "logit": Logit,
+    "probit": Probit,
+    "cloglog": Cloglog,
+}
@@ -1,75 +1,233 @@
-class OffsetLogitModel(torch.nn.Module):
-    def __init__(self):
+"""
+One-inflated binary regression fitted for all respondents at once with
+PyTorch on the CPU.
+
+Every respondent has its own const_coef, zipf_coef and phi_coef, stored
+as parameter tensors with one entry per respondent. The model and the
+normal(0, 1) priors are the same as fit_stan(...) in regress, so this gives
+the same MAP estimates without a CmdStan run per respondent. The penalised
+Bernoulli log likelihood of the whole dataset is maximised with L-BFGS.
+Respondents are independent, so the gradient of the total is each
+respondent's own gradient, and a respondent has converged when its
+gradient is below GRAD_TOL. To help L-BFGS, which works with the joint
+problem, the intercept is fitted at each respondent's mean zipf rather than
+at zero, which roughly decorrelates it from the slope.
+
+The number of intra-op threads can be set with the TORCH_THREADS
+environment variable.
+"""
+import os
+
+import numpy
+import pandas
+import torch
+from torch.nn import functional as F
+
+from .inflated import NUM_PARAMS, start_params
+from .links import FLOAT_EPS, LINKS
+
+
+PRIOR_SCALE = 1.0
+MAXITER = 1000
+HISTORY_SIZE = 20
+GRAD_TOL = 1e-5
+CONVERGED_GRAD_FACTOR = 10
+
+
+def log_probs(eta, link):
+    """
+    log p and log(1 - p) for the uninflated probability p of knowing.
+    """
+    if link == "logit":
+        return F.logsigmoid(eta), F.logsigmoid(-eta)
+    elif link == "probit":
+        return torch.special.log_ndtr(eta), torch.special.log_ndtr(-eta)
+    elif link == "cloglog":
+        exp_eta = torch.exp(eta)
+        return torch.log(torch.clamp(-torch.expm1(-exp_eta), min=FLOAT_EPS)), -exp_eta
+    else:
+        raise ValueError(f"Unknown link: {link}")
+
+
+class OneInflatedModel(torch.nn.Module):
+    """
+    Responses are split into the known and unknown ones up front. Unknown
+    responses only need the uninflated probability per response since
+    their inflation term is the same for all of a respondent's unknown
+    responses.
+    """
+    def __init__(self, codes, num_groups, x, y, link, start, prior_scale=PRIOR_SCALE):
         super().__init__()
-        self.linear = torch.nn.Linear(1, 1)
-        self.sigmoid = torch.nn.Sigmoid()
-        self.offset = torch.nn.Parameter(torch.tensor(0.0), requires_grad=True)
-        # self.loss_fn = torch.nn.BCELoss()
-        self.loss_fn = torch.nn.MSELoss()
-        # self.loss_fn = torch.nn.L1Loss()
-
-    def forward(self, x):
-        lin = self.linear(x)
-        # print("lin", lin)
-        sig_pred = torch.sigmoid(lin)
-        # return sig_pred
-        sig_off = torch.sigmoid(self.offset)
-        # print("sig", sig_pred, sig_off)
-        # return sig_off + (1.0 - sig_off) * sig_pred
-        return sig_off + sig_pred - sig_off * sig_pred
-
-    def forward_loss(self, x, y):
-        y_hat = self.forward(x)
-        # print("y_hat", y_hat)
-        loss = self.loss_fn(y_hat[:, 0], y)
-        # print("loss", loss)
-        return loss
+        self.num_groups = num_groups
+        self.link = link
+        self.prior_scale = prior_scale
+        codes = torch.as_tensor(codes, dtype=torch.int64)
+        x = torch.as_tensor(x, dtype=torch.float64)
+        known = torch.as_tensor(y, dtype=torch.bool)
+        counts = torch.bincount(codes, minlength=num_groups)
+        self.x_mean = torch.zeros(num_groups, dtype=torch.float64).index_add_(
+            0, codes, x
+        ) / counts.clamp(min=1)
+        x_centred = x - self.x_mean[codes]
+        self.one_codes = codes[known]
+        self.one_x = x_centred[known]
+        self.zero_codes = codes[~known]
+        self.zero_x = x_centred[~known]
+        self.num_zero = torch.bincount(self.zero_codes, minlength=num_groups)
+        start = torch.as_tensor(start, dtype=torch.float64)
+        self.centred_coef = torch.nn.Parameter(start[:, 0] + start[:, 1] * self.x_mean)
+        self.zipf_coef = torch.nn.Parameter(start[:, 1].clone())
+        self.phi_coef = torch.nn.Parameter(start[:, 2].clone())
+
+    @property
+    def const_coef(self):
+        return self.centred_coef - self.zipf_coef * self.x_mean
+
+    def group_sum(self, codes, values):
+        return torch.zeros(self.num_groups, dtype=values.dtype).index_add_(0, codes, values)
+
+    def log_lik(self):
+        """
+        The log likelihood of each respondent.
+        """
+        log_pi = F.logsigmoid(self.phi_coef)
+        log_not_pi = F.logsigmoid(-self.phi_coef)
+        # Gathered together since indexing dominates the cost
+        centred_coef, zipf_coef, one_log_pi, one_log_not_pi = torch.stack(
+            [self.centred_coef, self.zipf_coef, log_pi, log_not_pi], dim=1
+        )[self.one_codes].unbind(dim=1)
+        one_log_p = log_probs(centred_coef + zipf_coef * self.one_x, self.link)[0]
+        centred_coef, zipf_coef = torch.stack(
+            [self.centred_coef, self.zipf_coef], dim=1
+        )[self.zero_codes].unbind(dim=1)
+        zero_log_not_p = log_probs(centred_coef + zipf_coef * self.zero_x, self.link)[1]
+        return (
+            self.group_sum(
+                self.one_codes,
+                torch.logaddexp(one_log_pi, one_log_not_pi + one_log_p)
+            )
+            + self.num_zero * log_not_pi
+            + self.group_sum(self.zero_codes, zero_log_not_p)
+        )
 
+    def log_prior(self):
+        return -0.5 * (
+            self.const_coef ** 2 + self.zipf_coef ** 2 + self.phi_coef ** 2
+        ) / self.prior_scale ** 2
 
-def fit_offset_logit(x, y):
-    from torch.optim import Adam
+    def forward(self):
+        return -(self.log_lik() + self.log_prior()).sum()
 
-    model = OffsetLogitModel()
+    def params(self):
+        return torch.stack(
+            [self.const_coef, self.zipf_coef, self.phi_coef], dim=1
+        ).detach().numpy()
+
+
+def fit_torch_inflated(
+    codes,
+    num_groups,
+    x,
+    y,
+    link,
+    start=None,
+    prior_scale=PRIOR_SCALE,
+    maxiter=MAXITER,
+    grad_tol=GRAD_TOL,
+):
     """
-    optimizer = LBFGS(
-        ,
-        lr=1,
-        history_size=10,
-        max_iter=300,
-        tolerance_change=0,
-        tolerance_grad=1e-5,
-    )
+    Fit the one-inflated model to every group in codes. Returns a dict of
+    per-group arrays.
+    """
+    threads = os.environ.get("TORCH_THREADS")
+    if threads:
+        torch.set_num_threads(int(threads))
+    params = numpy.full((num_groups, NUM_PARAMS), numpy.nan)
+    if start is not None:
+        params[:] = start
+    cold = ~numpy.isfinite(params).all(axis=1)
+    if cold.any():
+        params[cold] = start_params(
+            codes, num_groups, x, numpy.asarray(y, dtype=float), LINKS[link]
+        )[cold]
+    model = OneInflatedModel(codes, num_groups, x, y, link, params, prior_scale)
 
     def closure():
-        optimizer.zero_grad()
-        loss = model.forward_loss(x, y)
+        model.zero_grad()
+        loss = model()
         loss.backward()
         return loss
 
+    optimizer = torch.optim.LBFGS(
+        model.parameters(),
+        lr=1,
+        max_iter=maxiter,
+        history_size=HISTORY_SIZE,
+        tolerance_grad=grad_tol,
+        tolerance_change=0,
+        line_search_fn="strong_wolfe"
+    )
     optimizer.step(closure)
-    state = optimizer.state[next(iter(optimizer.state))]
-    print("state", state)
-    """
-    # x.requires_grad_(True)
+    closure()
+    grad = torch.stack([
+        model.centred_coef.grad, model.zipf_coef.grad, model.phi_coef.grad
+    ], dim=1).abs().amax(dim=1).numpy()
+    with torch.no_grad():
+        llf = model.log_lik().numpy()
+    return {
+        "params": model.params(),
+        "llf": llf,
+        "iterations": numpy.full(
+            num_groups, optimizer.state[model.centred_coef].get("n_iter", 0)
+        ),
+        # The line search stops making progress once changes to the total
+        # loss are within rounding, which can leave a few respondents just
+        # short of grad_tol
+        "converged": grad <= CONVERGED_GRAD_FACTOR * grad_tol,
+    }
 
-    opt = Adam(
-        [{"params": [model.offset], "lr": 0.1}, {"params": model.linear.parameters()}],
-        1,
-    )
-    model.train()
-    for epoch in range(100):
-        # Train
-        opt.zero_grad()
-        loss = model.forward_loss(x, y)
-        loss.backward()
-        opt.step()
-        train_loss = loss.item()
-        print("loss", train_loss)
 
-    return model
+def torch_cols(result, respondents):
+    params = result["params"]
+    ok = numpy.isfinite(params).all(axis=1) & numpy.isfinite(result["llf"])
+    cols = {
+        "const_coef": params[:, 0],
+        "zipf_coef": params[:, 1],
+        "phi_coef": params[:, 2],
+        "aic": 2 * NUM_PARAMS - 2 * result["llf"],
+    }
+    cols = {k: numpy.where(ok, v, numpy.nan) for k, v in cols.items()}
+    cols["respondent"] = respondents.to_numpy()
+    cols["iterations"] = result["iterations"]
+    cols["converged"] = result["converged"] & ok
+    cols["failure"] = numpy.where(ok, None, "torch_error")
+    return cols
 
 
-def print_model(model):
-    print("Weight", model.linear.weight.detach())
-    print("Bias", model.linear.bias.detach())
-    print("Background", model.sigmoid(model.offset.detach()))
+def fit_batched_torch(df, link, start=None):
+    codes, respondents = pandas.factorize(df["respondent"], sort=True)
+    result = fit_torch_inflated(
+        codes,
+        len(respondents),
+        df["zipf"].to_numpy(dtype=float),
+        df["known"].to_numpy(dtype=bool),
+        link,
+        start=start,
+    )
+    return torch_cols(result, respondents)
+
+
+def fit_dense_torch(dense, link, start=None):
+    """
+    fit_batched_torch(...) for freqknowfit.dense.DenseResponses, without
+    going through the long DataFrame.
+    """
+    result = fit_torch_inflated(
+        numpy.repeat(numpy.arange(len(dense)), dense.num_items),
+        len(dense),
+        numpy.tile(dense.zipf, len(dense)),
+        dense.known.ravel(),
+        link,
+        start=start,
+    )
+    return torch_cols(result, dense.respondents)
@@ -1,4 +1,5 @@
 import os
+import time
 import numpy
 import click
 from functools import partial
@@ -6,9 +7,25 @@ import pandas
 from os.path import join as pjoin
 import warnings
 from math import nan
-from os.path import exists
 from string import Template
 
+from ..dataset import iter_chunks, respondent_sizes, score_levels
+from ..dense import DenseResponses
+from .results import prepare_output, write_manifest, write_part
+
+
+# Per-respondent instrumentation written alongside the results by
+# write_part(...). Fit functions may return any of these besides seconds,
+# which is filled in by fit_methods(...). Batched methods only have the time
+# of each chunk, which is split equally between its respondents.
+STATS_COLUMNS = ["seconds", "iterations", "converged", "failure", "start"]
+STATS_DEFAULTS = {
+    "iterations": nan,
+    "converged": None,
+    "failure": None,
+    "start": None,
+}
+
 
 STATSMODELS_NANS = {
     "const_coef": nan,
@@ -27,11 +44,20 @@ def maybe_print_summary(fit):
         print(fit.summary())
 
 
-def fit_statsmodels(df_resp, link):
+def design_matrix(df_resp):
+    from statsmodels.tools.tools import add_constant
+
+    return add_constant(df_resp["zipf"])
+
+
+def usable_start(start):
+    return start is not None and numpy.isfinite(start).all()
+
+
+def fit_statsmodels(df_resp, link, design=None, start=None):
     from statsmodels.genmod.families import links as L
     from statsmodels.genmod.families import Binomial
     from statsmodels.genmod.generalized_linear_model import GLM
-    from statsmodels.tools.tools import add_constant
     from statsmodels.tools.sm_exceptions import PerfectSeparationError
     from statsmodels.tools.eval_measures import aicc
 
@@ -43,6 +69,8 @@ def fit_statsmodels(df_resp, link):
         link_func = L.cloglog()
     else:
         assert False
+    if design is None:
+        design = design_matrix(df_resp)
 
     with warnings.catch_warnings():
         # TODO: Fixed in next statsmodels release
@@ -52,17 +80,26 @@ def fit_statsmodels(df_resp, link):
         try:
             model = GLM(
                 df_resp["known"],
-                add_constant(df_resp["zipf"]),
+                design,
                 family=Binomial(link=link_func)
-            ).fit()
+            ).fit(start_params=start[:2] if usable_start(start) else None)
         except PerfectSeparationError:
-            return STATSMODELS_NANS
+            return {
+                **STATSMODELS_NANS,
+                "converged": False,
+                "failure": "perfect_separation",
+            }
 
     maybe_print_summary(model)
+    stats = {
+        "iterations": model.fit_history["iteration"],
+        "converged": model.converged,
+    }
     if len(model.params) < 2:
-        return STATSMODELS_NANS
+        return {**STATSMODELS_NANS, **stats, "failure": "degenerate_zipf"}
 
     return {
+        **stats,
         "const_coef": model.params[0],
         "zipf_coef": model.params[1],
         "const_err": model.bse[0],
@@ -151,19 +188,19 @@ generated quantities {
 STAN_LOGIT_MODEL = STAN_MODEL.substitute(REG_LINK="inv_logit")
 STAN_PROBIT_MODEL = STAN_MODEL.substitute(REG_LINK="Phi")
 STAN_CLOGLOG_MODEL = STAN_MODEL.substitute(REG_LINK="inv_cloglog")
+STAN_MODELS = {
+    "logit": STAN_LOGIT_MODEL,
+    "probit": STAN_PROBIT_MODEL,
+    "cloglog": STAN_CLOGLOG_MODEL,
+}
 
 
-def get_model_path():
-    return os.environ.get("STAN_PROG_DIR", os.environ.get("TMPDIR", "/tmp"))
-
-
-def ensure_model_at_path(path, contents):
-    if exists(path):
-        with open(path, "r") as inf:
-            if inf.read() == contents:
-                return
-    with open(path, "w") as outf:
-        outf.write(contents)
+STAN_NANS = {
+    "const_coef": nan,
+    "zipf_coef": nan,
+    "phi_coef": nan,
+    "aic": nan,
+}
 
 
 class SliceTaker:
@@ -180,29 +217,30 @@ class SliceTaker:
         self.cursor += length
 
 
-def fit_stan(df_resp, link):
-    from statsmodels.tools.tools import add_constant
-    from cmdstanpy import CmdStanModel
+def stan_inits(start):
+    if not usable_start(start):
+        return None
+    return {"inflate_coef": start[2], "reg_coef": start[:2]}
 
-    if link == "logit":
-        stan_code = STAN_LOGIT_MODEL
-    elif link == "probit":
-        stan_code = STAN_PROBIT_MODEL
-    elif link == "cloglog":
-        stan_code = STAN_CLOGLOG_MODEL
-    else:
-        assert False
-    full_path = pjoin(get_model_path(), link + ".stan")
-    ensure_model_at_path(full_path, stan_code)
-    model = CmdStanModel(link, full_path)
+
+def fit_stan(df_resp, link, design=None, start=None):
+    from .stan_cache import get_stan_model
+
+    if design is None:
+        design = design_matrix(df_resp)
+    model = get_stan_model(link, STAN_MODELS[link])
     n = len(df_resp)
     k = 2
-    mle = model.optimize({
-        "N": n,
-        "K": k,
-        "x": add_constant(df_resp["zipf"].to_numpy()),
-        "y": df_resp["known"].to_numpy().astype(numpy.int32),
-    })
+    try:
+        mle = model.optimize({
+            "N": n,
+            "K": k,
+            "x": design.to_numpy(),
+            "y": df_resp["known"].to_numpy().astype(numpy.int32),
+        }, inits=stan_inits(start))
+    except RuntimeError:
+        # cmdstanpy raises on errors and when optimisation doesn't converge
+        return {**STAN_NANS, "converged": False, "failure": "stan_error"}
     taker = SliceTaker(mle.optimized_params_np)
     lp = taker.take(1)[0]
     inflate_coef = taker.take(1)[0]
@@ -219,29 +257,406 @@ def fit_stan(df_resp, link):
         "zipf_coef": reg_coef[1],
         "phi_coef": inflate_coef,
         "aic": aic,
+        "converged": True,
+    }
+
+
+STAN_SLIM_MODEL = Template("""
+functions {
+    real inflated_log_lik(
+        real inflate_coef,
+        vector reg_coef,
+        matrix x_one,
+        vector w_one,
+        matrix x_zero,
+        vector w_zero
+    ) {
+        real inflate_mags = inv_logit(inflate_coef);
+        return (
+            dot_product(
+                w_one,
+                log(inflate_mags + (1 - inflate_mags) * $REG_LINK(x_one * reg_coef))
+            )
+            + sum(w_zero) * log1m(inflate_mags)
+            + dot_product(w_zero, log1m($REG_LINK(x_zero * reg_coef)))
+        );
+    }
+}
+
+data {
+    int<lower=0> N_one;
+    int<lower=0> N_zero;
+    int<lower=0> K;
+    matrix[N_one, K] x_one;
+    vector<lower=0>[N_one] w_one;
+    matrix[N_zero, K] x_zero;
+    vector<lower=0>[N_zero] w_zero;
+}
+
+parameters {
+    real inflate_coef;
+    vector[K] reg_coef;
+}
+
+model {
+    inflate_coef ~ normal(0, 1);
+    reg_coef ~ normal(0, 1);
+    target += inflated_log_lik(inflate_coef, reg_coef, x_one, w_one, x_zero, w_zero);
+}
+
+generated quantities {
+    real log_lik = inflated_log_lik(
+        inflate_coef, reg_coef, x_one, w_one, x_zero, w_zero
+    );
+}
+""")
+
+
+STAN_SLIM_MODELS = {
+    "logit": STAN_SLIM_MODEL.substitute(REG_LINK="inv_logit"),
+    "probit": STAN_SLIM_MODEL.substitute(REG_LINK="Phi"),
+    "cloglog": STAN_SLIM_MODEL.substitute(REG_LINK="inv_cloglog"),
+}
+
+
+def weighted_design(zipfs):
+    counts = zipfs.value_counts(sort=False)
+    x = numpy.column_stack([
+        numpy.ones(len(counts)),
+        counts.index.to_numpy(dtype=float)
+    ])
+    return x, counts.to_numpy(dtype=float)
+
+
+def fit_stan_slim(df_resp, link, design=None, start=None):
+    """
+    Like fit_stan(...) but with a model which only outputs the parameters
+    and the total log likelihood. Repeated (zipf, known) pairs are collapsed
+    into weights first, so the shared design matrix is not used.
+    """
+    from .stan_cache import get_stan_model
+
+    model = get_stan_model(link + "Slim", STAN_SLIM_MODELS[link])
+    known = df_resp["known"].to_numpy().astype(bool)
+    x_one, w_one = weighted_design(df_resp["zipf"][known])
+    x_zero, w_zero = weighted_design(df_resp["zipf"][~known])
+    k = 2
+    try:
+        mle = model.optimize(
+            {
+                "N_one": len(w_one),
+                "N_zero": len(w_zero),
+                "K": k,
+                "x_one": x_one,
+                "w_one": w_one,
+                "x_zero": x_zero,
+                "w_zero": w_zero,
+            },
+            inits=stan_inits(start),
+            # Only a handful of values per iteration with this model
+            save_iterations=True
+        )
+    except RuntimeError:
+        return {**STAN_NANS, "converged": False, "failure": "stan_error"}
+    taker = SliceTaker(mle.optimized_params_np)
+    lp = taker.take(1)[0]
+    inflate_coef = taker.take(1)[0]
+    reg_coef = taker.take(k)
+    log_lik = taker.take(1)[0]
+    num_params = k + 1
+
+    return {
+        "const_coef": reg_coef[0],
+        "zipf_coef": reg_coef[1],
+        "phi_coef": inflate_coef,
+        "aic": 2 * num_params - 2 * log_lik,
+        # The first row is the initial values
+        "iterations": len(mle.optimized_iterations_np) - 1,
+        "converged": True,
     }
 
 
+class ScreenedMethod:
+    """
+    Marks a per-respondent method whose certain failures can be found for
+    every respondent at once by the checks in screen. failures(screen) gives
+    each respondent's failure or None, and those which fail get nans
+    instead of being fitted.
+    """
+    def __init__(self, fit, failures, nans):
+        self.fit = fit
+        self.failures = failures
+        self.nans = nans
+
+    def __call__(self, df_resp, **kwargs):
+        return self.fit(df_resp, **kwargs)
+
+
+def statsmodels_screen_failures(screen):
+    from .screen import statsmodels_failures
+
+    return statsmodels_failures(screen)
+
+
+def stan_screen_failures(screen):
+    from .screen import stan_failures
+
+    return stan_failures(screen)
+
+
+def screened_statsmodels(link):
+    return ScreenedMethod(
+        partial(fit_statsmodels, link=link),
+        statsmodels_screen_failures,
+        STATSMODELS_NANS
+    )
+
+
+def screened_stan(link):
+    return ScreenedMethod(partial(fit_stan, link=link), stan_screen_failures, STAN_NANS)
+
+
+class BatchedMethod:
+    """
+    Marks a method which fits every respondent of a dataframe in one call
+    and returns a dict of columns, rather than being called per respondent.
+    fit_dense, if given, does the same for DenseResponses.
+
+    Methods which estimate something from the whole dataset first, like the
+    population of a mixed model, give prepare. It is called once as
+    prepare(dfin), before any respondent is fitted, and returns keyword
+    arguments for fit_all and fit_dense, which bind(...) fixes.
+
+    score is set by methods which model the score column rather than known,
+    so that it is read too.
+    """
+    def __init__(self, fit_all, fit_dense=None, prepare=None, score=False):
+        self.fit_all = fit_all
+        self.fit_dense = fit_dense
+        self.prepare = prepare
+        self.score = score
+
+    def bind(self, **kwargs):
+        """
+        This method with kwargs fixed. prepare is kept, so that preparing
+        and binding again overrides them.
+        """
+        return BatchedMethod(
+            partial(self.fit_all, **kwargs),
+            None if self.fit_dense is None else partial(self.fit_dense, **kwargs),
+            prepare=self.prepare,
+            score=self.score
+        )
+
+
+def fit_batched(df, link, start=None):
+    from .batched_glm import fit_batched_glm
+
+    return fit_batched_glm(df, link, start=start)
+
+
+def fit_batched_dense(dense, link, start=None):
+    from .batched_glm import fit_dense_glm
+
+    return fit_dense_glm(dense, link, start=start)
+
+
+def fit_mle_inflated(df, link, one_inflated, start=None):
+    from .inflated import fit_batched_inflated
+
+    return fit_batched_inflated(df, link, one_inflated=one_inflated, start=start)
+
+
+def fit_torch(df, link, start=None):
+    from .pytorch_oneinf import fit_batched_torch
+
+    return fit_batched_torch(df, link, start=start)
+
+
+def fit_torch_dense(dense, link, start=None):
+    from .pytorch_oneinf import fit_dense_torch
+
+    return fit_dense_torch(dense, link, start=start)
+
+
+def prepare_glmm(dfin, link):
+    from .glmm import fit_population
+
+    population = fit_population(
+        partial(iter_chunks, dfin, FIT_COLUMNS, allow_dense=True), link
+    )
+    print(
+        f"GLMM {link} population after {population['iterations']} passes: "
+        f"mean {population['mean']}, cov {population['cov'].tolist()}"
+        + ("" if population["converged"] else " (not converged)")
+    )
+    return {"population": population}
+
+
+def fit_glmm(df, link, population, start=None):
+    from .glmm import fit_batched_glmm
+
+    return fit_batched_glmm(df, link, population, start=start)
+
+
+def glmm_method(link):
+    fit = partial(fit_glmm, link=link)
+    return BatchedMethod(fit, fit, prepare=partial(prepare_glmm, link=link))
+
+
+def prepare_cumulative(dfin):
+    # Every respondent gets a threshold column for each level of the dataset
+    return {"levels": score_levels(dfin).tolist()}
+
+
+def fit_cumulative(df, link, levels, start=None):
+    from .cumulative import fit_batched_cumulative
+
+    return fit_batched_cumulative(df, link, levels, start=start)
+
+
+def cumulative_method(link):
+    fit = partial(fit_cumulative, link=link)
+    return BatchedMethod(fit, fit, prepare=prepare_cumulative, score=True)
+
+
 METHODS = {
-    "statsmodelsGlmLogit": partial(fit_statsmodels, link="logit"),
-    "statsmodelsGlmProbit": partial(fit_statsmodels, link="probit"),
-    "statsmodelsGlmCloglog": partial(fit_statsmodels, link="cloglog"),
-    "stanLogit": partial(fit_stan, link="logit"),
-    "stanProbit": partial(fit_stan, link="probit"),
-    "stanCloglog": partial(fit_stan, link="cloglog"),
+    "statsmodelsGlmLogit": screened_statsmodels("logit"),
+    "statsmodelsGlmProbit": screened_statsmodels("probit"),
+    "statsmodelsGlmCloglog": screened_statsmodels("cloglog"),
+    "stanLogit": screened_stan("logit"),
+    "stanProbit": screened_stan("probit"),
+    "stanCloglog": screened_stan("cloglog"),
+    "stanSlimLogit": partial(fit_stan_slim, link="logit"),
+    "stanSlimProbit": partial(fit_stan_slim, link="probit"),
+    "stanSlimCloglog": partial(fit_stan_slim, link="cloglog"),
+    "batchedGlmLogit": BatchedMethod(
+        partial(fit_batched, link="logit"),
+        partial(fit_batched_dense, link="logit")
+    ),
+    "batchedGlmProbit": BatchedMethod(
+        partial(fit_batched, link="probit"),
+        partial(fit_batched_dense, link="probit")
+    ),
+    "batchedGlmCloglog": BatchedMethod(
+        partial(fit_batched, link="cloglog"),
+        partial(fit_batched_dense, link="cloglog")
+    ),
+    "mleOiLogit": BatchedMethod(partial(fit_mle_inflated, link="logit", one_inflated=True)),
+    "mleOiProbit": BatchedMethod(partial(fit_mle_inflated, link="probit", one_inflated=True)),
+    "mleOiCloglog": BatchedMethod(partial(fit_mle_inflated, link="cloglog", one_inflated=True)),
+    "mleZiLogit": BatchedMethod(partial(fit_mle_inflated, link="logit", one_inflated=False)),
+    "mleZiProbit": BatchedMethod(partial(fit_mle_inflated, link="probit", one_inflated=False)),
+    "mleZiCloglog": BatchedMethod(partial(fit_mle_inflated, link="cloglog", one_inflated=False)),
+    "torchOiLogit": BatchedMethod(
+        partial(fit_torch, link="logit"),
+        partial(fit_torch_dense, link="logit")
+    ),
+    "torchOiProbit": BatchedMethod(
+        partial(fit_torch, link="probit"),
+        partial(fit_torch_dense, link="probit")
+    ),
+    "torchOiCloglog": BatchedMethod(
+        partial(fit_torch, link="cloglog"),
+        partial(fit_torch_dense, link="cloglog")
+    ),
+    "laplaceGlmmLogit": glmm_method("logit"),
+    "laplaceGlmmProbit": glmm_method("probit"),
+    "laplaceGlmmCloglog": glmm_method("cloglog"),
+    "cumulativeLogit": cumulative_method("logit"),
+    "cumulativeProbit": cumulative_method("probit"),
+    "cumulativeCloglog": cumulative_method("cloglog"),
 }
 
 
-@click.command()
-@click.argument("method")
-@click.argument("dfin", type=click.Path(exists=True))
-@click.argument("dfout", type=click.Path())
-def main(method, dfin, dfout):
-    print("Loading dataframe")
-    fit = METHODS[method]
-    df = pandas.read_parquet(dfin)
-    print("Loaded!")
-    cols = None
+def fit_batched_timed(fit, df, name=None, warm=None):
+    # Batched methods only have a total time, which is shared equally
+    # between the respondents
+    start_time = time.perf_counter()
+    dense = isinstance(df, DenseResponses)
+    kwargs = {}
+    if warm is not None:
+        if dense:
+            # Only the range of each respondent's zipfs matters to the
+            # warm starts
+            respondents = df.respondents
+            codes = numpy.repeat(numpy.arange(len(df)), 2)
+            x = numpy.tile(df.zipf[[0, -1]], len(df))
+        else:
+            codes, respondents = pandas.factorize(df["respondent"], sort=True)
+            x = df["zipf"].to_numpy(dtype=float)
+        kwargs["start"], source = warm.start(name, respondents, codes, x)
+    cols = (fit.fit_dense if dense else fit.fit_all)(df, **kwargs)
+    seconds = time.perf_counter() - start_time
+    num_resps = len(cols["respondent"])
+    if warm is not None:
+        cols["start"] = source
+    for k, v in STATS_DEFAULTS.items():
+        cols.setdefault(k, [v] * num_resps)
+    cols["seconds"] = numpy.full(num_resps, seconds / max(num_resps, 1))
+    return cols
+
+
+def fit_methods(fits, df, done=None, warm_start=False, population=None):
+    """
+    Fit every respondent in df with each of fits (a dict from method name
+    to an entry of METHODS) in a single pass, returning a dict from method
+    name to a dict of columns including STATS_COLUMNS. Per-respondent
+    methods share the grouping and design matrix. Respondents in done[name]
+    are skipped for that method. Methods with nothing to fit are left out.
+
+    df may also be DenseResponses, which batched methods with a fit_dense
+    use directly. It is converted to a DataFrame once for the others.
+
+    With warm_start, each method starts from the fits of the methods before
+    it (batched methods come first) as described in warm_start. Only the
+    per-respondent methods fall back on other links or the population
+    starts from warm_start.population_starts(...).
+    """
+    done = done or {}
+    warm = None
+    if warm_start:
+        from .warm_start import WarmStarts
+
+        warm = WarmStarts(population)
+    dense = None
+    if isinstance(df, DenseResponses):
+        dense = df
+        df = None
+        if not all(
+            isinstance(fit, BatchedMethod) and fit.fit_dense is not None
+            for fit in fits.values()
+        ):
+            df = dense.to_frame()
+    results = {}
+    per_resp = {}
+    for name, fit in fits.items():
+        if not isinstance(fit, BatchedMethod):
+            per_resp[name] = fit
+            continue
+        if dense is not None and fit.fit_dense is not None:
+            todo = dense
+            if done.get(name):
+                todo = dense.drop_respondents(done[name])
+        else:
+            todo = df
+            if done.get(name):
+                todo = df[~df["respondent"].isin(list(done[name]))]
+        if len(todo):
+            results[name] = fit_batched_timed(fit, todo, name, warm)
+            if warm is not None:
+                warm.record(name, results[name])
+    if not per_resp:
+        return results
+    # Failures known in advance, by method and then respondent
+    screened = {}
+    if any(isinstance(fit, ScreenedMethod) for fit in per_resp.values()):
+        from .screen import screen_respondents
+
+        screen = screen_respondents(df)
+        for name, fit in per_resp.items():
+            if isinstance(fit, ScreenedMethod):
+                screened[name] = dict(zip(screen.respondents, fit.failures(screen)))
     idx1 = 1
     grouped = df.groupby("respondent")
     for respondent, resp_df in grouped:
@@ -249,19 +664,298 @@ def main(method, dfin, dfout):
             print(
                 f"Regressing respondent {respondent} [{idx1} / {len(grouped)}]"
             )
-        row = fit(resp_df)
-        if cols is None:
-            cols = {k: [] for k in row}
-            cols["respondent"] = []
-        for k, v in row.items():
-            cols[k].append(v)
-        cols["respondent"].append(respondent)
         idx1 += 1
-    print("Writing dataframe")
-    os.makedirs(dfout, exist_ok=True)
-    full_out = pjoin(dfout, "00000001.parquet")
-    pandas.DataFrame(cols).to_parquet(full_out)
-    print("Written")
+        todo = [
+            name for name in per_resp
+            if respondent not in done.get(name, ())
+        ]
+        if not todo:
+            continue
+        design = design_matrix(resp_df)
+        for name in todo:
+            start_time = time.perf_counter()
+            kwargs = {}
+            stats = {}
+            failure = screened.get(name, {}).get(respondent)
+            if failure is not None:
+                fitted = {**per_resp[name].nans, "converged": False, "failure": failure}
+            else:
+                if warm is not None:
+                    start, source = warm.start(
+                        name,
+                        [respondent],
+                        numpy.zeros(len(resp_df), dtype=numpy.int64),
+                        resp_df["zipf"].to_numpy(dtype=float),
+                        fallback=True
+                    )
+                    kwargs["start"] = start[0]
+                    stats["start"] = source[0]
+                fitted = per_resp[name](resp_df, design=design, **kwargs)
+            row = {**STATS_DEFAULTS, **stats, **fitted}
+            row["seconds"] = time.perf_counter() - start_time
+            row["respondent"] = respondent
+            if warm is not None:
+                warm.record(name, {k: [v] for k, v in row.items()})
+            cols = results.setdefault(name, {k: [] for k in row})
+            for k, v in row.items():
+                cols[k].append(v)
+    return results
+
+
+def fit_respondents(fit, df):
+    """
+    Fit every respondent in df with a single method returning a dict of
+    columns, including STATS_COLUMNS.
+    """
+    return fit_methods({None: fit}, df).get(None)
+
+
+FIT_COLUMNS = ["zipf", "known"]
+PART_RESPONDENTS = 256
+
+
+def part_bounds(first_resps, starts, end, part_respondents, run_starts=None):
+    """
+    Where to cut a chunk into parts, given the respondents first_resps
+    starting at row positions starts and the number of rows end. Parts are
+    cut at each respondent of run_starts and then every part_respondents
+    respondents (or not at all if part_respondents is None).
+    """
+    new_run = numpy.zeros(len(starts), dtype=bool)
+    new_run[0] = True
+    if run_starts is not None:
+        new_run |= pandas.Index(first_resps).isin(run_starts)
+    cut = new_run
+    if part_respondents is not None:
+        idx = numpy.arange(len(starts))
+        idx_in_run = idx - numpy.maximum.accumulate(numpy.where(new_run, idx, 0))
+        cut = new_run | (idx_in_run % part_respondents == 0)
+    return list(starts[cut]) + [end]
+
+
+def iter_fitted_parts(fits, chunks, part_respondents=PART_RESPONDENTS, run_starts=None, **kwargs):
+    """
+    Fit chunks of whole respondents with fit_methods(..., **kwargs),
+    yielding a dict of DataFrames of results every part_respondents
+    respondents (or every chunk when all methods are batched) so they can be
+    written out as they finish. A new part is also started at each
+    respondent of run_starts, so that resumed runs never write parts which
+    span parts already on disk.
+    """
+    all_batched = all(isinstance(fit, BatchedMethod) for fit in fits.values())
+    if all_batched:
+        part_respondents = None
+    for chunk in chunks:
+        dense = isinstance(chunk, DenseResponses)
+        if dense:
+            first_resps = chunk.respondents
+            starts = numpy.arange(len(chunk))
+        else:
+            resps = chunk["respondent"].to_numpy()
+            starts = numpy.flatnonzero(numpy.r_[True, resps[1:] != resps[:-1]])
+            first_resps = resps[starts]
+        bounds = part_bounds(first_resps, starts, len(chunk), part_respondents, run_starts)
+        for lo, hi in zip(bounds, bounds[1:]):
+            part = chunk.take(slice(lo, hi)) if dense else chunk.iloc[lo:hi]
+            results = fit_methods(fits, part, **kwargs)
+            yield {
+                name: pandas.DataFrame(cols)
+                for name, cols in results.items()
+            }
+
+
+def split_respondents(sizes, num_shards):
+    """
+    Split the respondents of sizes (as from respondent_sizes(...)) into at
+    most num_shards contiguous runs with roughly equal numbers of rows.
+    """
+    counts = sizes.to_numpy()
+    rows_before = counts.cumsum() - counts
+    shard_of_resp = rows_before * num_shards // max(counts.sum(), 1)
+    return [
+        resps.to_list()
+        for _, resps in sizes.index.to_series().groupby(shard_of_resp, sort=True)
+    ]
+
+
+def resumed_run_starts(respondents, ranks, done):
+    """
+    The respondents, of the sorted respondents still to be fitted, which
+    start a run of consecutive ranks with the same methods already done.
+    """
+    respondents = pandas.Index(respondents)
+    resp_ranks = ranks[respondents].to_numpy()
+    status = numpy.column_stack([
+        respondents.isin(list(method_done)) for method_done in done.values()
+    ])
+    new_run = numpy.r_[
+        True,
+        (numpy.diff(resp_ranks) != 1) | (status[1:] != status[:-1]).any(axis=1)
+    ]
+    return set(respondents[new_run])
+
+
+def fit_shard(methods, dfin, dfouts, ranks, respondents=None, prepared=None, **kwargs):
+    prepared = prepared or {}
+    fits = {}
+    for method in methods:
+        fits[method] = METHODS[method]
+        if method in prepared:
+            fits[method] = fits[method].bind(**prepared[method])
+    columns = FIT_COLUMNS
+    if any(isinstance(fit, BatchedMethod) and fit.score for fit in fits.values()):
+        columns = FIT_COLUMNS + ["score"]
+    parts = iter_fitted_parts(
+        fits,
+        iter_chunks(dfin, columns, respondents, allow_dense=True),
+        **kwargs
+    )
+    num_written = 0
+    for results in parts:
+        for method, df_part in results.items():
+            write_part(
+                df_part.drop(columns=STATS_COLUMNS),
+                dfouts[method],
+                ranks[df_part["respondent"].iloc[0]],
+                stats=df_part[["respondent", *STATS_COLUMNS]]
+            )
+            num_written += len(df_part)
+    return num_written
+
+
+def fit_dataset(methods, dfin, dfouts, workers=1, resume=False, warm_start=False):
+    """
+    Fit the list of methods to dfin, writing each method's results to the
+    directory at the same position of dfouts.
+    """
+    dfouts = dict(zip(methods, dfouts))
+    done = {
+        method: prepare_output(dfout, method, dfin, resume)
+        for method, dfout in dfouts.items()
+    }
+    sizes = respondent_sizes(dfin)
+    ranks = pandas.Series(numpy.arange(len(sizes)), index=sizes.index)
+    resuming = any(done.values())
+    if resuming:
+        # Respondents are loaded if any method still needs them
+        all_done = set.intersection(*done.values())
+        sizes = sizes[~sizes.index.isin(list(all_done))]
+        for method, method_done in done.items():
+            print(f"Resuming {method}: {len(method_done)} respondents already fitted")
+        print(f"{len(sizes)} respondents remaining")
+    fit_kwargs = {"done": done, "warm_start": warm_start}
+    if resuming and len(sizes):
+        fit_kwargs["run_starts"] = resumed_run_starts(sizes.index, ranks, done)
+    if warm_start and len(sizes) and not all(
+        isinstance(METHODS[method], BatchedMethod) for method in methods
+    ):
+        from .warm_start import method_kind, population_starts
+
+        # Drawn from all respondents, not just those remaining, so that
+        # resumed runs get the same starts
+        fit_kwargs["population"] = population_starts(
+            dfin,
+            ranks.index,
+            {method_kind(method)[0] for method in methods}
+        )
+        print(f"Population starts: {fit_kwargs['population']}")
+    prepared = {}
+    for method in methods:
+        fit = METHODS[method]
+        if isinstance(fit, BatchedMethod) and fit.prepare is not None and len(
+            sizes.index.difference(list(done[method]))
+        ):
+            # Always prepared from the whole dataset so that resumed runs
+            # get the same results
+            prepared[method] = fit.prepare(dfin)
+    if not len(sizes):
+        print("All respondents already fitted")
+    elif workers <= 1:
+        fit_shard(
+            methods,
+            dfin,
+            dfouts,
+            ranks,
+            sizes.index.to_list() if resuming else None,
+            prepared,
+            **fit_kwargs
+        )
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        shards = split_respondents(sizes, workers)
+        print(f"Fitting {len(shards)} shards using {workers} workers")
+        # Share the cores between the workers' PyTorch thread pools
+        os.environ.setdefault(
+            "TORCH_THREADS", str(max(1, (os.cpu_count() or 1) // workers))
+        )
+        with ProcessPoolExecutor(workers) as executor:
+            futures = [
+                executor.submit(
+                    fit_shard,
+                    methods,
+                    dfin,
+                    dfouts,
+                    ranks,
+                    shard_resps,
+                    prepared,
+                    **{
+                        **fit_kwargs,
+                        "done": {
+                            method: method_done & set(shard_resps)
+                            for method, method_done in done.items()
+                        },
+                    }
+                )
+                for shard_resps in shards
+            ]
+            for future in futures:
+                print(f"Fitted {future.result()} respondent x method pairs")
+    for method, dfout in dfouts.items():
+        manifest = write_manifest(dfout, method)
+        print(
+            f"{method}: written {manifest['num_rows']} rows "
+            f"in {len(manifest['parts'])} parts"
+        )
+
+
+@click.command()
+@click.argument("methods")
+@click.argument("dfin", type=click.Path(exists=True))
+@click.argument("dfouts", nargs=-1, required=True, type=click.Path())
+@click.option("--workers", type=int, default=1)
+@click.option("--resume/--no-resume", default=False)
+@click.option(
+    "--warm-start/--cold-start",
+    default=False,
+    help="Start each fit from related fits of the same respondent"
+)
+@click.option(
+    "--server",
+    type=click.Path(),
+    envvar="FREQKNOWFIT_FIT_SERVER",
+    help="Unix socket of a fit_server to fit on, if one is listening there"
+)
+def main(methods, dfin, dfouts, workers, resume, warm_start, server):
+    """
+    Fit METHODS (comma separated) to DFIN in a single pass over the data,
+    writing each method's results to the corresponding directory of DFOUTS.
+    """
+    methods = methods.split(",")
+    for method in methods:
+        if method not in METHODS:
+            raise click.BadParameter(f"Unknown method: {method}")
+    if len(dfouts) != len(methods):
+        raise click.BadParameter(
+            f"Got {len(methods)} methods but {len(dfouts)} output directories"
+        )
+    if server is not None:
+        from .fit_server import request_fit
+
+        if request_fit(server, methods, dfin, dfouts, workers, resume, warm_start):
+            return
+        print(f"No fit server at {server}; fitting in-process")
+    fit_dataset(methods, dfin, list(dfouts), workers, resume, warm_start)
 
 
 if __name__ == "__main__":
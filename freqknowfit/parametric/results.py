@@ -0,0 +1,153 @@
+"""
+Crash-safe output directories of fitted results.
+
+Results are written as many small parquet parts as respondents finish. Each
+part is named after the rank of its first respondent (in sorted respondent
+order) and is moved into place atomically, so that reading the directory in
+filename order always gives respondents in order, whatever the number of
+workers or resumptions. The directory is only complete once MANIFEST_NAME
+has been written. Files starting with "." or "_" are ignored by
+pandas.read_parquet(...).
+
+Per-respondent fitting statistics (wall time, iterations, convergence and
+failure reason) go into parts with the same names under STATS_DIR.
+"""
+import os
+import json
+from glob import glob
+from os.path import basename, exists, join as pjoin
+
+import pandas
+
+
+MANIFEST_NAME = "_MANIFEST.json"
+RUN_NAME = "_RUN.json"
+STATS_DIR = "_stats"
+
+
+def part_path(dfout, first_rank):
+    return pjoin(dfout, f"{first_rank + 1:08d}.parquet")
+
+
+def write_parquet_atomic(df, full_out):
+    out_dir, name = os.path.split(full_out)
+    tmp_path = pjoin(out_dir, f".{name}.{os.getpid()}.tmp")
+    df.to_parquet(tmp_path)
+    os.replace(tmp_path, full_out)
+
+
+def write_part(df, dfout, first_rank, stats=None):
+    # The stats go first since the results part marks the respondents done
+    if stats is not None:
+        os.makedirs(pjoin(dfout, STATS_DIR), exist_ok=True)
+        write_parquet_atomic(stats, part_path(pjoin(dfout, STATS_DIR), first_rank))
+    full_out = part_path(dfout, first_rank)
+    write_parquet_atomic(df, full_out)
+    return full_out
+
+
+def list_parts(dfout):
+    return sorted(glob(pjoin(dfout, "[0-9]*.parquet")))
+
+
+def list_stats_parts(dfout):
+    return list_parts(pjoin(dfout, STATS_DIR))
+
+
+def run_info(method, dfin):
+    stat = os.stat(dfin)
+    return {
+        "method": method,
+        "dfin": os.path.abspath(dfin),
+        "dfin_size": stat.st_size,
+        "dfin_mtime": stat.st_mtime,
+    }
+
+
+def prepare_output(dfout, method, dfin, resume):
+    """
+    Get dfout ready to be written to. Returns the set of respondents which
+    are already fitted when resuming a run of the same method on the same
+    input, otherwise any previous parts are removed.
+    """
+    os.makedirs(dfout, exist_ok=True)
+    info = run_info(method, dfin)
+    run_path = pjoin(dfout, RUN_NAME)
+    manifest_path = pjoin(dfout, MANIFEST_NAME)
+    if exists(manifest_path):
+        os.remove(manifest_path)
+    done = set()
+    prev_info = None
+    if exists(run_path):
+        with open(run_path) as inf:
+            prev_info = json.load(inf)
+    if resume and prev_info == info:
+        parts = list_parts(dfout)
+        for path in parts:
+            done.update(
+                pandas.read_parquet(path, columns=["respondent"])["respondent"]
+            )
+        # Stats of parts which never made it are refitted
+        part_names = {basename(path) for path in parts}
+        for path in list_stats_parts(dfout):
+            if basename(path) not in part_names:
+                os.remove(path)
+    else:
+        for path in list_parts(dfout) + list_stats_parts(dfout):
+            os.remove(path)
+        with open(run_path, "w") as outf:
+            json.dump(info, outf)
+    return done
+
+
+def write_manifest(dfout, method=None):
+    parts = list_parts(dfout)
+    manifest = {
+        "method": method,
+        "parts": [basename(path) for path in parts],
+        "num_rows": sum(
+            len(pandas.read_parquet(path, columns=["respondent"]))
+            for path in parts
+        ),
+    }
+    with open(pjoin(dfout, MANIFEST_NAME), "w") as outf:
+        json.dump(manifest, outf)
+    return manifest
+
+
+def read_fit_method(fitin):
+    """
+    The method recorded in the manifest or run info of a fitted results
+    directory, or None if it is not known.
+    """
+    for name in [MANIFEST_NAME, RUN_NAME]:
+        path = pjoin(fitin, name)
+        if exists(path):
+            with open(path) as inf:
+                method = json.load(inf).get("method")
+            if method is not None:
+                return method
+    return None
+
+
+def path_params(path):
+    """
+    Parse Paramspace style key~value path components, e.g.
+    model~glmLogit/dataset~blp.parquets.
+    """
+    params = {}
+    for component in path.replace(".parquets", "").split(os.sep):
+        if "~" in component:
+            key, value = component.split("~", 1)
+            params[key] = value
+    return params
+
+
+def list_runs(work):
+    """
+    Every complete results directory under work.
+    """
+    return sorted(
+        os.path.dirname(path)
+        for path in glob(pjoin(work, "**", "*.parquets", MANIFEST_NAME), recursive=True)
+    )
@@ -0,0 +1,68 @@
+"""
+Cheap checks of all respondents at once for fits which are bound to fail,
+so that the per-respondent methods can record the failure without running
+statsmodels or CmdStan.
+
+A respondent is separated when a threshold on zipf splits their known
+responses from their unknown ones, including when all of their responses
+are known or all unknown. Their binary GLM has no maximum likelihood
+estimate. It is degenerate when all of their zipfs are the same, so the
+slope can't be told apart from the intercept.
+"""
+from dataclasses import dataclass
+
+import numpy
+import pandas
+
+from .batched_glm import group_extent
+
+
+@dataclass
+class Screen:
+    respondents: pandas.Index
+    one_class: numpy.ndarray
+    separated: numpy.ndarray
+    degenerate: numpy.ndarray
+
+
+def screen_respondents(df):
+    """
+    Screen every respondent of the DataFrame df.
+    """
+    codes, respondents = pandas.factorize(df["respondent"], sort=True)
+    num_groups = len(respondents)
+    x = df["zipf"].to_numpy(dtype=float)
+    known = df["known"].to_numpy(dtype=bool)
+    x_min, x_max = group_extent(codes, num_groups, x)
+    known_min, known_max = group_extent(codes[known], num_groups, x[known])
+    unknown_min, unknown_max = group_extent(codes[~known], num_groups, x[~known])
+    num_known = numpy.bincount(codes[known], minlength=num_groups)
+    one_class = (num_known == 0) | (num_known == numpy.bincount(codes, minlength=num_groups))
+    # Empty extents are (inf, -inf) so one class compares as separated too
+    separated = (unknown_max < known_min) | (known_max < unknown_min)
+    return Screen(respondents, one_class, separated, x_min == x_max)
+
+
+def statsmodels_failures(screen):
+    """
+    The failures fit_statsmodels(...) would give: statsmodels raises
+    PerfectSeparationError for any one class respondent, even with a single
+    zipf, and otherwise drops the constant zipf column.
+    """
+    return numpy.where(
+        screen.one_class,
+        "perfect_separation",
+        numpy.where(
+            screen.degenerate,
+            "degenerate_zipf",
+            numpy.where(screen.separated, "perfect_separation", None)
+        )
+    )
+
+
+def stan_failures(screen):
+    """
+    The failures fit_stan(...) would give. The priors keep separated fits
+    finite, but a single zipf leaves its design matrix a column short.
+    """
+    return numpy.where(screen.degenerate, "degenerate_zipf", None)
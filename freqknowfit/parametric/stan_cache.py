@@ -0,0 +1,62 @@
+"""
+Machine-wide cache of compiled Stan models.
+
+Each model is stored under a file name derived from its name and a hash of
+its code, so changing the code never reuses a stale executable. Placement of
+the .stan file and compilation happen under an exclusive file lock, so
+concurrent jobs sharing the cache directory compile each model only once.
+Within a process the loaded CmdStanModel is kept and reused.
+"""
+import os
+import hashlib
+from contextlib import contextmanager
+from os.path import exists, join as pjoin
+
+
+_MODELS = {}
+
+
+def get_model_path():
+    return os.environ.get("STAN_PROG_DIR", os.environ.get("TMPDIR", "/tmp"))
+
+
+def code_hash(code):
+    return hashlib.sha256(code.encode("utf-8")).hexdigest()[:16]
+
+
+@contextmanager
+def file_lock(path):
+    import fcntl
+
+    with open(path, "a") as lockf:
+        fcntl.flock(lockf, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockf, fcntl.LOCK_UN)
+
+
+def write_atomic(path, contents):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as outf:
+        outf.write(contents)
+    os.replace(tmp_path, path)
+
+
+def get_stan_model(name, code):
+    from cmdstanpy import CmdStanModel
+
+    key = (name, code_hash(code))
+    model = _MODELS.get(key)
+    if model is not None:
+        return model
+    cache_dir = pjoin(get_model_path(), "freqknowfit-stan")
+    os.makedirs(cache_dir, exist_ok=True)
+    base = pjoin(cache_dir, f"{name}-{key[1]}")
+    stan_path = base + ".stan"
+    with file_lock(base + ".lock"):
+        if not exists(stan_path):
+            write_atomic(stan_path, code)
+        model = CmdStanModel(name, stan_path)
+    _MODELS[key] = model
+    return model
@@ -0,0 +1,164 @@
+"""
+Starting values passed between related fits of the same respondent.
+
+Fits of the same respondent with different links or with/without inflation
+have closely related coefficients. WarmStarts remembers the coefficients of
+every method fitted so far and gives later methods a start in their own
+parametrisation: coefficients from another link are converted by matching
+the predicted probabilities over the respondent's range of zipf, and fits
+without inflation start the inflation coefficient at DEFAULT_PHI_START.
+
+Plain GLMs are concave so they take a start from any link, but are
+otherwise left to IRLS which starts well from the respondent's own data.
+The inflated likelihoods have local optima which converted starts from
+another link can land in, so by default inflated fits only start from fits
+with the same link. Optimisers without a good start of their own (Stan's
+are random) can fall back on starts from other links and then on a
+population level start: the median coefficients of plain GLMs fitted to a
+subsample of respondents.
+
+Nearly separated respondents have no finite optimum, so whether they are
+flagged as separated can depend on the start.
+"""
+import numpy
+import pandas
+
+from .batched_glm import group_extent, irls
+from .inflated import DEFAULT_PHI_START
+from .links import LINKS, clean
+from ..nonparametric.regression import method_regression_config
+
+
+# Points at which predicted probabilities are matched when converting
+# between links
+NUM_MATCH_POINTS = 5
+POPULATION_RESPONDENTS = 200
+START_COLUMNS = ["const_coef", "zipf_coef", "phi_coef"]
+
+
+def method_kind(method):
+    """
+    The link name and inflation ("oi", "zi" or None) of a method.
+    """
+    conf = method_regression_config(method)
+    inflation = "oi" if conf.oi else ("zi" if conf.zi else None)
+    return conf.link.name.lower(), inflation
+
+
+def convert_params(params, src_link, dst_link, x_min, x_max):
+    """
+    Convert (num_groups, 2) coefficients from src_link to dst_link by least
+    squares between the linear predictors giving the same probability at
+    evenly spaced points in [x_min, x_max].
+    """
+    if src_link == dst_link:
+        return params
+    src = LINKS[src_link]
+    dst = LINKS[dst_link]
+    x = numpy.linspace(0, 1, NUM_MATCH_POINTS)[None, :]
+    x = x_min[:, None] + x * (x_max - x_min)[:, None]
+    with numpy.errstate(invalid="ignore", over="ignore"):
+        prob = src.inverse(params[:, :1] + params[:, 1:] * x)
+        eta = dst.link(numpy.clip(clean(prob), 1e-6, 1 - 1e-6))
+        x_mean = x.mean(axis=1, keepdims=True)
+        eta_mean = eta.mean(axis=1, keepdims=True)
+        zipf_coef = (
+            ((x - x_mean) * (eta - eta_mean)).sum(axis=1)
+            / ((x - x_mean) ** 2).sum(axis=1)
+        )
+    const_coef = eta_mean[:, 0] - zipf_coef * x_mean[:, 0]
+    return numpy.stack([const_coef, zipf_coef], axis=1)
+
+
+def population_starts(dfin, respondents, links, num_respondents=POPULATION_RESPONDENTS, seed=0):
+    """
+    Median coefficients of plain GLMs with each of links fitted to a random
+    subsample of num_respondents of respondents from dfin. The subsample
+    only depends on respondents and seed.
+    """
+    from ..dataset import read_dataset
+
+    respondents = numpy.asarray(respondents)
+    if len(respondents) > num_respondents:
+        rng = numpy.random.default_rng(seed)
+        respondents = rng.choice(respondents, num_respondents, replace=False)
+    df = read_dataset(dfin, ["zipf", "known"], respondents.tolist())
+    codes, uniques = pandas.factorize(df["respondent"], sort=True)
+    x = df["zipf"].to_numpy(dtype=float)
+    y = df["known"].to_numpy(dtype=float)
+    starts = {}
+    for link in links:
+        result = irls(codes, len(uniques), x, y, link)
+        params = result.params[result.ok & result.converged]
+        if len(params):
+            starts[link] = numpy.median(params, axis=0)
+    return starts
+
+
+class WarmStarts:
+    """
+    Coefficients of the methods fitted so far, by respondent. Meant to live
+    for a single pass over a part of the data.
+    """
+    def __init__(self, population=None):
+        self.population = population or {}
+        # method -> (link, inflation, {respondent: START_COLUMNS array})
+        self.sources = {}
+
+    def record(self, method, cols):
+        link, inflation = method_kind(method)
+        num_resps = len(cols["respondent"])
+        params = numpy.column_stack([
+            numpy.asarray(cols.get(col, numpy.full(num_resps, numpy.nan)), dtype=float)
+            for col in START_COLUMNS
+        ])
+        store = self.sources.setdefault(method, (link, inflation, {}))[2]
+        store.update(zip(cols["respondent"], params))
+
+    def start(self, method, respondents, codes, x, fallback=False):
+        """
+        Starting values as a (len(respondents), 3) array of START_COLUMNS
+        for method, given the respondents' data as codes into respondents
+        and zipfs x. Also returns a description of the source of each start.
+        Rows without any start are NaN. With fallback, inflated fits may
+        also start from other links or the population.
+        """
+        link, inflation = method_kind(method)
+        any_link = inflation is None or fallback
+        num_groups = len(respondents)
+        x_min, x_max = group_extent(codes, num_groups, x)
+        start = numpy.full((num_groups, 3), numpy.nan)
+        source = numpy.full(num_groups, None, dtype=object)
+        missing = numpy.full(3, numpy.nan)
+        # Closest relatives first: same link then same inflation
+        ordered = sorted(
+            self.sources.items(),
+            key=lambda item: (item[1][0] != link, item[1][1] != inflation)
+        )
+        for src_method, (src_link, src_inflation, store) in ordered:
+            if src_link != link and not any_link:
+                break
+            todo = numpy.isnan(start[:, 0])
+            if not todo.any():
+                break
+            src_params = numpy.array([
+                store.get(resp, missing) for resp in respondents
+            ]).reshape(num_groups, 3)
+            coefs = convert_params(
+                src_params[:, :2], src_link, link, x_min, x_max
+            )
+            found = todo & numpy.isfinite(coefs).all(axis=1)
+            start[found, :2] = coefs[found]
+            if inflation is not None and src_inflation == inflation:
+                start[found, 2] = src_params[found, 2]
+            source[found] = src_method
+        todo = numpy.isnan(start[:, 0])
+        if todo.any() and inflation is not None and fallback and link in self.population:
+            start[todo, :2] = self.population[link]
+            source[todo] = "population"
+        start[:, 2] = numpy.where(
+            numpy.isnan(start[:, 2]) & ~numpy.isnan(start[:, 0]),
+            DEFAULT_PHI_START,
+            start[:, 2]
+        )
+        return start, source